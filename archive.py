@@ -0,0 +1,237 @@
+import array
+import collections
+
+from journal import SNAPSHOT_ORDER, pack_height, unpack_height
+from simple_order_matching import Currency
+
+# the archive keeps the final state of filled, canceled and expired
+# orders as fixed-size records, the same records as in a snapshot of
+# journal.py, instead of the Order objects. the engine hands closed
+# orders over to its archive, see MatchingEngine.archive_orders.
+#
+# the latest records are kept in memory in a preallocated ring buffer of
+# capacity records. the ids and timestamps of the records are kept in
+# arrays next to it and the slots are found by id through a hash table
+# with linear probing, which is an array as well, so a record costs
+# about 100 bytes of memory. once the buffer is full or the oldest
+# record is older than max_age, the oldest records are moved to a file.
+# the age is only checked from time to time. the records of each move
+# are sorted by order id and appended to the file as segment, so only
+# the range of ids and the position of each segment are kept in memory
+# and a record is found by binary search within the segments. without a
+# file, the oldest records are dropped instead.
+#
+# the file is only used while the archive is open. currencies are
+# stored as ids of Currency.intern.
+
+# multiplier of the hash of order ids, which is odd, so consecutive ids
+# are spread over the hash table
+ID_HASH = 2654435761
+
+# typecode of arrays of 64-bit integers, as "q" requires Python 3
+INTEGERS = "l" if array.array("l").itemsize == 8 else "q"
+
+
+class ArchivedOrder(collections.namedtuple("ArchivedOrder", [
+        "id", "timestamp", "status", "currency_for_sale", "amount_for_sale",
+        "initial_amount_for_sale", "currency_desired", "amount_desired",
+        "initial_amount_desired", "expiry"])):
+    """Final state of a closed order."""
+    __slots__ = ()
+
+    def get_received_amount(self):
+        return self.initial_amount_desired - self.amount_desired
+
+
+class OrderArchive(object):
+    """Bounded store of the final state of closed orders.
+
+    At most capacity records are kept in memory. max_age is given in
+    units of Order.timestamp and compared to the newest archived order:
+
+        archive = engine.archive_orders(OrderArchive("orders.archive"))
+        engine.get_order(order_id)
+    """
+
+    def __init__(self, path=None, capacity=100000, max_age=None):
+        assert 0 < capacity
+        self.capacity = capacity
+        self.max_age = max_age
+        # the age is checked after this number of records, so the 
+        # segments don't get too small
+        self.age_interval = max(1, capacity // 16)
+
+        # ring buffer of the records in the order of archiving, which 
+        # starts with the oldest record at slot start
+        self.buffer = bytearray(capacity * SNAPSHOT_ORDER.size)
+        self.ids = array.array(INTEGERS, [0]) * capacity
+        self.timestamps = array.array(INTEGERS, [0]) * capacity
+        self.start = 0
+        self.count = 0
+        # hash table of slot + 1 by order id or 0 for empty entries, 
+        # which is at most half full
+        table_size = 1
+        while table_size < 2 * capacity:
+            table_size *= 2
+        self.index = array.array(INTEGERS, [0]) * table_size
+        # timestamp of the newest archived order
+        self.newest = None
+
+        # (first order id, last order id, offset, number of records)
+        # of the segments in the file
+        self.segments = []
+        self.size = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.file = None
+        if path is not None:
+            self.file = open(path, "w+b")
+
+    def __len__(self):
+        return self.count + self.spilled
+
+    def __contains__(self, order_id):
+        return self.get(order_id) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def locate(self, order_id):
+        """Get the position of an order id in the hash table or of the 
+        empty entry, where it would be inserted."""
+        index = self.index
+        ids = self.ids
+        mask = len(index) - 1
+        position = (order_id * ID_HASH) & mask
+        while index[position] and ids[index[position] - 1] != order_id:
+            position = (position + 1) & mask
+        return position
+
+    def unindex(self, position):
+        """Remove an entry of the hash table.
+
+        The following entries are moved back, so no entry is separated 
+        from its hash position by an empty entry."""
+        index = self.index
+        ids = self.ids
+        mask = len(index) - 1
+        index[position] = 0
+        hole = position
+        position = (position + 1) & mask
+        while index[position]:
+            home = (ids[index[position] - 1] * ID_HASH) & mask
+            if (position - home) & mask >= (position - hole) & mask:
+                index[hole] = index[position]
+                index[position] = 0
+                hole = position
+            position = (position + 1) & mask
+
+    def add(self, order):
+        """Archive a closed Order."""
+        position = self.locate(order.id)
+        slot = self.index[position] - 1
+        if slot < 0:
+            if self.count == self.capacity:
+                # half of the records are moved at once, so the segments
+                # don't get too small
+                self.spill(self.count - self.capacity // 2)
+                position = self.locate(order.id)
+            slot = (self.start + self.count) % self.capacity
+            self.count += 1
+            self.index[position] = slot + 1
+            self.ids[slot] = order.id
+
+        self.timestamps[slot] = order.timestamp
+        SNAPSHOT_ORDER.pack_into(
+            self.buffer, slot * SNAPSHOT_ORDER.size,
+            order.id, order.timestamp, order.status,
+            Currency.intern(order.currency_for_sale),
+            order.amount_for_sale, order.initial_amount_for_sale,
+            Currency.intern(order.currency_desired),
+            order.amount_desired, order.initial_amount_desired,
+            pack_height(order.expiry))
+
+        if self.newest is None or order.timestamp > self.newest:
+            self.newest = order.timestamp
+
+        if self.max_age is not None and \
+                self.count % self.age_interval == 0:
+            count = 0
+            oldest = self.newest - self.max_age
+            while count < self.count and self.timestamps[
+                    (self.start + count) % self.capacity] < oldest:
+                count += 1
+            if count:
+                self.spill(count)
+
+    def spill(self, count):
+        """Move the count oldest records to the file."""
+        slots = [(self.start + i) % self.capacity for i in range(count)]
+        for slot in slots:
+            self.unindex(self.locate(self.ids[slot]))
+        self.start = (self.start + count) % self.capacity
+        self.count -= count
+        if self.file is None:
+            self.dropped += count
+            return
+
+        # the slots are only reused by the following additions
+        size = SNAPSHOT_ORDER.size
+        slots.sort(key=self.ids.__getitem__)
+        self.file.seek(self.size)
+        self.file.write(bytearray().join(
+            self.buffer[slot * size:(slot + 1) * size] for slot in slots))
+        self.segments.append(
+            (self.ids[slots[0]], self.ids[slots[-1]], self.size, count))
+        self.size += count * size
+        self.spilled += count
+
+    def get(self, order_id):
+        """Get the ArchivedOrder of an order id or None."""
+        slot = self.index[self.locate(order_id)] - 1
+        if slot >= 0:
+            return self.unpack(SNAPSHOT_ORDER.unpack_from(
+                self.buffer, slot * SNAPSHOT_ORDER.size))
+
+        for (first_id, last_id, offset, count) in reversed(self.segments):
+            if first_id <= order_id <= last_id:
+                record = self.find(order_id, offset, count)
+                if record is not None:
+                    return self.unpack(SNAPSHOT_ORDER.unpack(record))
+        return None
+
+    def find(self, order_id, offset, count):
+        """Find the record of an order id in a segment of the file."""
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            self.file.seek(offset + middle * SNAPSHOT_ORDER.size)
+            record = self.file.read(SNAPSHOT_ORDER.size)
+            record_id = SNAPSHOT_ORDER.unpack(record)[0]
+            if record_id == order_id:
+                return record
+            if record_id < order_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def unpack(self, values):
+        (order_id, timestamp, status, currency_for_sale, amount_for_sale,
+         initial_amount_for_sale, currency_desired, amount_desired,
+         initial_amount_desired, expiry) = values
+        return ArchivedOrder(
+            order_id, timestamp, status,
+            Currency.get_name(currency_for_sale), amount_for_sale,
+            initial_amount_for_sale, Currency.get_name(currency_desired),
+            amount_desired, initial_amount_desired, unpack_height(expiry))
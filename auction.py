@@ -0,0 +1,301 @@
+import collections
+import itertools
+
+from simple_order_matching import \
+    OrderStatus, MatchingEngine, DEFAULT_STRATEGY, get_market, get_price_key
+
+# instead of matching each order on arrival, the orders of a block are
+# collected and each market is cleared by an auction at a single price,
+# which is followed by continuous matching of the orders, which still
+# cross.
+#
+# within a market (a, b) "sellers" offer currency a and "buyers" offer
+# currency b. prices are expressed in units of b per unit of a. a seller
+# accepts any price above its unit price and sells only as much of a as
+# needed to receive the desired amount of b. a buyer accepts any price
+# below the inverse of its unit price and buys the desired amount of a.
+#
+# only whole units are exchanged and sellers receive the price rounded
+# up, so a seller supplies at most amount desired / price units of a,
+# rounded down. the clearing price is the limit price, at which the most
+# whole units of a can be exchanged. ties are resolved by the smallest
+# imbalance between supply and demand and then by the lowest price. the
+# executed orders are then paired in time priority.
+#
+# as sellers offer less of a at higher prices, the supply doesn't always
+# grow with the price, and rounding may keep orders from being paired at
+# the clearing price. orders, which still cross after the auction, are
+# therefore matched continuously: the later of the best orders of both
+# sides is executed at the price of the other one, until the book no
+# longer crosses. the result is thus not a strict uniform-price clear.
+
+
+def get_bid_key(order):
+    """Get the price key of the inverse unit price of a buyer."""
+    return get_price_key(order.amount_for_sale, order.amount_desired)
+
+
+def get_time_priority(order):
+    return (order.timestamp, order.id)
+
+
+def get_clearing_price(sellers, buyers):
+    """Determine the price of the auction of a market.
+
+    Returns the price as (numerator, denominator) tuple in units of the
+    currency desired by sellers per unit of the currency they offer or
+    None, if the orders don't cross."""
+    # (price key, desired amount of b)
+    asks = sorted((order.price_key, order.amount_desired)
+                  for order in sellers)
+    # (price key, desired amount of a)
+    bids = sorted((get_bid_key(order), order.amount_desired)
+                  for order in buyers)
+
+    # every limit price is a candidate, exact prices are kept by key
+    candidates = {}
+    for order in sellers:
+        candidates[order.price_key] = \
+            (order.amount_desired, order.amount_for_sale)
+    for order in buyers:
+        candidates[get_bid_key(order)] = \
+            (order.amount_for_sale, order.amount_desired)
+
+    # walk up the prices with cumulative sums of both sides. the supply 
+    # in whole units is bounded by the desired amount of b divided by 
+    # the price, so the exact supply is only calculated for the 
+    # candidates, which may exchange the most units
+    revenue_desired = 0
+    demand = sum(amount_desired for (_, amount_desired) in bids)
+    i = j = 0
+    # (upper bound of the volume, price key, number of sellers, demand)
+    bounds = []
+
+    for price_key in sorted(candidates):
+        (numerator, denominator) = candidates[price_key]
+
+        # sellers with a lower limit take part at this price
+        while i < len(asks) and asks[i][0] <= price_key:
+            revenue_desired += asks[i][1]
+            i += 1
+
+        # buyers with a lower limit drop out at this price
+        while j < len(bids) and bids[j][0] < price_key:
+            demand -= bids[j][1]
+            j += 1
+
+        volume = min(revenue_desired * denominator // numerator, demand)
+        if volume > 0:
+            bounds.append((volume, price_key, i, demand))
+
+    # the highest bounds first and lower prices first among equal ones
+    bounds.sort(key=lambda bound: (-bound[0], bound[1]))
+    best_price = None
+
+    for (bound, price_key, count, demand) in bounds:
+        if best_price is not None and bound < best_volume:
+            break
+        (numerator, denominator) = candidates[price_key]
+        supply = sum(amount_desired * denominator // numerator
+                     for (_, amount_desired) in asks[:count])
+        volume = min(supply, demand)
+        if volume <= 0:
+            continue
+        imbalance = abs(supply - demand)
+
+        if best_price is not None and (volume, -imbalance, -price_key) \
+                <= (best_volume, -best_imbalance, -best_key):
+            continue
+
+        best_price = (numerator, denominator)
+        best_key = price_key
+        best_volume = volume
+        best_imbalance = imbalance
+
+    return best_price
+
+
+class BatchAuctionEngine(MatchingEngine):
+    """Matching engine, which clears each market once per block.
+
+    Orders are collected with add_order or add_orders and executed by
+    clear_block. Open orders remain in the orderbook and take part in
+    the auctions of the following blocks."""
+    __slots__ = ['pending']
+
+    def __init__(self, validate=True, strategy=DEFAULT_STRATEGY):
+        MatchingEngine.__init__(self, validate, strategy)
+        self.pending = []
+
+    def add_order(self, order_new):
+        """Collect an order for the current block.
+
+        Returns the Order, which is executed or listed by clear_block."""
+        if self.validate:
+            self.report_order_arrival(order_new)
+        else:
+            self.onOrderArrival(order_new)
+        self.pending.append(order_new)
+        return order_new
+
+    def clear_block(self):
+        """Clear all markets with orders of the current block.
+
+        Returns the list of collected Orders after execution or
+        listing."""
+        orders = self.pending
+        self.pending = []
+
+        # orders, which expired before the block is cleared, are not 
+        # executed
+        markets = collections.OrderedDict()
+        for order in orders:
+            if self.orderbook.is_expired(order):
+                self.expire_order(order)
+            else:
+                markets.setdefault(get_market(order), []).append(order)
+
+        for (market, new_orders) in markets.items():
+            self.clear_market(market, new_orders)
+
+        return orders
+
+    def clear_market(self, market, new_orders):
+        """Execute the open and new orders of a market at one price.
+
+        Remaining new orders are added to the orderbook, whereupon the
+        orders, which still cross, are matched continuously."""
+        (currency_a, currency_b) = market
+        sellers = [order for order in new_orders
+                   if order.currency_for_sale == currency_a]
+        buyers = [order for order in new_orders
+                  if order.currency_for_sale == currency_b]
+
+        # open orders, which can't cross with the best price of the 
+        # other side, never take part, so only the crossing part of 
+        # the orderbook is visited
+        resting_sellers = self.orderbook.queues.get((currency_a, currency_b))
+        resting_buyers = self.orderbook.queues.get((currency_b, currency_a))
+
+        ask_keys = [order.price_key for order in sellers]
+        bid_keys = [get_bid_key(order) for order in buyers]
+        if resting_sellers:
+            ask_keys.append(resting_sellers.peek().price_key)
+        if resting_buyers:
+            bid_keys.append(get_bid_key(resting_buyers.peek()))
+
+        if ask_keys and bid_keys:
+            min_ask_key = min(ask_keys)
+            max_bid_key = max(bid_keys)
+            if resting_sellers:
+                sellers.extend(itertools.takewhile(
+                    lambda order: order.price_key <= max_bid_key,
+                    resting_sellers.iter_best()))
+            if resting_buyers:
+                buyers.extend(itertools.takewhile(
+                    lambda order: get_bid_key(order) >= min_ask_key,
+                    resting_buyers.iter_best()))
+
+            price = get_clearing_price(sellers, buyers)
+            if price is not None:
+                self.allocate(price, sellers, buyers)
+
+        for order in new_orders:
+            if order.status == OrderStatus.Filled:
+                self.retire(order)
+            else:
+                self.list_order(order)
+
+        self.uncross(currency_a, currency_b)
+
+    def uncross(self, currency_a, currency_b):
+        """Match the orders of a market, which cross after the auction.
+
+        The later of the best orders of both sides is executed against 
+        the other one, as if it had arrived after it."""
+        orderbook = self.orderbook
+        while True:
+            ask = orderbook.get_best_order(currency_a, currency_b)
+            bid = orderbook.get_best_order(currency_b, currency_a)
+            if ask is None or bid is None or not ask.accepts_price_of(bid):
+                return
+
+            (order_old, order_new) = sorted((ask, bid), key=get_time_priority)
+            self.execute_orders(order_old, order_new)
+            if order_new.status == OrderStatus.Filled:
+                orderbook.delist(order_new)
+                self.retire(order_new)
+            else:
+                orderbook.refresh(order_new)
+
+    def allocate(self, price, sellers, buyers):
+        """Pair sellers and buyers, which accept the price, by time."""
+        (numerator, denominator) = price
+        price_key = get_price_key(numerator, denominator)
+
+        sellers = sorted((order for order in sellers
+                          if order.price_key <= price_key),
+                         key=get_time_priority)
+        buyers = sorted((order for order in buyers
+                         if get_bid_key(order) >= price_key),
+                        key=get_time_priority)
+
+        i = j = 0
+        while i < len(sellers) and j < len(buyers):
+            seller = sellers[i]
+            buyer = buyers[j]
+
+            # the seller doesn't receive more than desired
+            amount_to_buyer = min(
+                buyer.amount_desired, seller.amount_for_sale,
+                seller.amount_desired * denominator // numerator)
+            if amount_to_buyer == 0:
+                i += 1
+                continue
+
+            # the seller receives the price, rounded up, but the buyer 
+            # doesn't pay more than its own limit, rounded down
+            amount_to_seller = min(
+                -(-amount_to_buyer * numerator // denominator),
+                amount_to_buyer * buyer.amount_for_sale
+                // buyer.amount_desired)
+
+            # rounding may leave no amount, which both orders accept
+            if amount_to_seller * seller.amount_for_sale \
+                    < amount_to_buyer * seller.amount_desired:
+                j += 1
+                continue
+
+            self.execute_auction_trade(
+                seller, buyer, amount_to_seller, amount_to_buyer)
+
+            if buyer.status == OrderStatus.Filled:
+                j += 1
+
+    def execute_auction_trade(self, seller, buyer, amount_to_seller,
+                              amount_to_buyer):
+        """Update both orders and the orderbook after a trade."""
+        validate = self.validate
+        if validate:
+            self.report_trade(seller, buyer, amount_to_seller, amount_to_buyer)
+        else:
+            self.onTrade(seller, buyer, amount_to_seller, amount_to_buyer)
+
+        # the seller takes the place of the listed order
+        if self.fills is not None:
+            self.fills.append(
+                seller.id, buyer.id, amount_to_seller, amount_to_buyer)
+
+        for (order, amount_received, amount_spent) in (
+                (seller, amount_to_seller, amount_to_buyer),
+                (buyer, amount_to_buyer, amount_to_seller)):
+            order.update_order(
+                amount_received, amount_spent, validate, self.strategy)
+
+            # orders of previous blocks are in the orderbook
+            if order.id in self.orderbook.orders:
+                if order.status == OrderStatus.Filled:
+                    self.orderbook.delist(order)
+                    self.retire(order)
+                else:
+                    self.orderbook.refresh(order)
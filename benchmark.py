@@ -0,0 +1,222 @@
+import argparse
+import multiprocessing
+import random
+import resource
+import timeit
+
+from simple_order_matching import Order, MatchingEngine
+from profiling import Profiler, format_snapshot
+from main import COIN
+
+# each scenario generates a seeded flow of actions, which is either
+# ("order", arguments of Order) or ("cancel", index), whereby index
+# refers to the n-th order of the flow. cancels of orders which are no
+# longer open are ignored by the engine, as usual.
+#
+# every scenario is run in its own process, so the peak memory usage
+# can be measured separately.
+
+
+def random_order(rng, currency_for_sale, currency_desired, price, spread,
+                 scale, timestamp):
+    """Create order arguments around a price with some spread."""
+    amount_for_sale = rng.randint(scale, 10 * scale)
+    unit_price = price * (1.0 + rng.uniform(-spread, spread))
+    amount_desired = max(1, int(amount_for_sale * unit_price))
+    return (currency_for_sale, amount_for_sale,
+            currency_desired, amount_desired, timestamp)
+
+
+def generate_deep_book(rng, count):
+    """A single market with a deep book on both sides.
+
+    Few orders cross the spread, so most orders are listed."""
+    flow = []
+    for i in range(count):
+        if rng.random() < 0.5:
+            flow.append(("order", random_order(
+                rng, "MSC", "BTC", 1.02, 0.2, 1000, i)))
+        else:
+            flow.append(("order", random_order(
+                rng, "BTC", "MSC", 1.02, 0.2, 1000, i)))
+    return flow
+
+
+def generate_many_pairs(rng, count, currencies=50):
+    """Orders spread over many markets."""
+    names = ["SP%i" % i for i in range(currencies)]
+    flow = []
+    for i in range(count):
+        (currency_for_sale, currency_desired) = rng.sample(names, 2)
+        flow.append(("order", random_order(
+            rng, currency_for_sale, currency_desired, 1.0, 0.05, 1000, i)))
+    return flow
+
+
+def generate_sweeps(rng, count, sweep_every=500):
+    """Resting orders on one side, which are swept by large orders."""
+    flow = []
+    for i in range(count):
+        if i % sweep_every == sweep_every - 1:
+            # desires roughly the amount of the last resting orders
+            amount_desired = sweep_every * 5000
+            flow.append(("order", (
+                "BTC", amount_desired * 2, "MSC", amount_desired, i)))
+        else:
+            flow.append(("order", random_order(
+                rng, "MSC", "BTC", 1.0, 0.3, 1000, i)))
+    return flow
+
+
+def generate_cancels(rng, count, cancel_ratio=0.8):
+    """Most orders are canceled and replaced shortly after listing."""
+    flow = []
+    orders = 0
+    for i in range(count):
+        if orders and rng.random() < cancel_ratio:
+            flow.append(("cancel", orders - 1 - min(orders - 1,
+                                                    int(rng.expovariate(0.1)))))
+        else:
+            if rng.random() < 0.5:
+                flow.append(("order", random_order(
+                    rng, "MSC", "BTC", 1.05, 0.1, 1000, i)))
+            else:
+                flow.append(("order", random_order(
+                    rng, "BTC", "MSC", 1.05, 0.1, 1000, i)))
+            orders += 1
+    return flow
+
+
+def generate_satoshi(rng, count):
+    """Divisible amounts with full precision and crossing prices."""
+    flow = []
+    for i in range(count):
+        if rng.random() < 0.5:
+            flow.append(("order", random_order(
+                rng, "MSC", "BTC", 0.23, 0.05, COIN // 100, i)))
+        else:
+            flow.append(("order", random_order(
+                rng, "BTC", "MSC", 1 / 0.23, 0.05, COIN // 100, i)))
+    return flow
+
+
+SCENARIOS = [
+    ("deep-book", generate_deep_book),
+    ("many-pairs", generate_many_pairs),
+    ("sweeps", generate_sweeps),
+    ("cancels", generate_cancels),
+    ("satoshi", generate_satoshi),
+]
+
+
+def percentile(latencies, p):
+    """Get the p-th percentile of sorted latencies."""
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def run_scenario(generate, count, seed, validate, profile=False):
+    """Run a scenario and measure the engine.
+
+    Returns a dict with the number of orders and cancels per second,
+    latency percentiles of add_order in seconds and the peak memory
+    usage in KiB. If profile is set, a snapshot of the Profiler is 
+    included as "profile"."""
+    flow = generate(random.Random(seed), count)
+
+    # orders are created up front, so only the engine is measured
+    actions = []
+    orders = []
+    for (action, payload) in flow:
+        if action == "order":
+            order = Order(*payload)
+            orders.append(order)
+            actions.append((True, order))
+        else:
+            actions.append((False, payload))
+
+    engine = MatchingEngine(validate)
+    timer = timeit.default_timer
+    latencies = []
+
+    profiler = Profiler()
+    if profile:
+        profiler.enable()
+
+    start = timer()
+    for (is_order, payload) in actions:
+        if is_order:
+            before = timer()
+            engine.add_order(payload)
+            latencies.append(timer() - before)
+        else:
+            engine.cancel_order(orders[payload].id)
+    elapsed = timer() - start
+
+    if profile:
+        profiler.disable()
+
+    latencies.sort()
+    result = {
+        "actions_per_second": len(actions) / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "p999": percentile(latencies, 0.999),
+        "open_orders": len(engine.orderbook.orders),
+        "peak_memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if profile:
+        result["profile"] = profiler.snapshot(engine.orderbook)
+    return result
+
+
+def run_isolated(generate, count, seed, validate, profile=False):
+    """Run a scenario in a separate process."""
+    (connection, child_connection) = multiprocessing.Pipe()
+
+    def target():
+        child_connection.send(
+            run_scenario(generate, count, seed, validate, profile))
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+    result = connection.recv()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the matching engine with synthetic order flow.")
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios to run, by default all of: %s" %
+                        ", ".join(name for (name, _) in SCENARIOS))
+    parser.add_argument("--orders", type=int, default=50000,
+                        help="number of actions per scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-validate", action="store_true",
+                        help="run the engine without sanity checks")
+    parser.add_argument("--profile", action="store_true",
+                        help="show the time spent in each stage")
+    args = parser.parse_args()
+
+    scenarios = [(name, generate) for (name, generate) in SCENARIOS
+                 if not args.scenarios or name in args.scenarios]
+
+    print("%-12s %12s %10s %10s %10s %10s %12s" % (
+        "scenario", "actions/s", "p50 us", "p99 us", "p999 us",
+        "open", "peak KiB"))
+    profiles = []
+    for (name, generate) in scenarios:
+        result = run_isolated(
+            generate, args.orders, args.seed, not args.no_validate,
+            args.profile)
+        if args.profile:
+            profiles.append((name, result["profile"]))
+        print("%-12s %12.0f %10.1f %10.1f %10.1f %10i %12i" % (
+            name, result["actions_per_second"],
+            result["p50"] * 1e6, result["p99"] * 1e6, result["p999"] * 1e6,
+            result["open_orders"], result["peak_memory"]))
+
+    # the profiled stages are shown after the results of all scenarios
+    for (name, snapshot) in profiles:
+        print("\n%s\n%s" % (name, format_snapshot(snapshot)))
@@ -0,0 +1,141 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the columnar store keeps the open orders of an Orderbook in NumPy
+# arrays, one per attribute, so that queries over the whole book run as
+# vectorized operations instead of Python loops. currencies are stored
+# as small integers, which are assigned in the order the currencies
+# appear.
+#
+# rows of removed orders are reused for new orders, so the arrays only
+# grow with the number of open orders.
+
+
+class ColumnarOrderStore(object):
+    """Columnar mirror of the open orders of an Orderbook.
+
+    The store is kept up to date after orderbook.attach(store)."""
+
+    COLUMNS = [
+        ("order_id", "int64"),
+        ("timestamp", "int64"),
+        ("currency_for_sale", "int32"),
+        ("amount_for_sale", "int64"),
+        ("currency_desired", "int32"),
+        ("amount_desired", "int64"),
+        ("unit_price", "float64"),
+        ("valid", "bool"),
+    ]
+
+    def __init__(self, capacity=1024):
+        if numpy is None:
+            raise ImportError("the columnar store requires NumPy")
+
+        for (name, dtype) in self.COLUMNS:
+            setattr(self, name, numpy.zeros(capacity, dtype))
+
+        # order id -> row
+        self.rows = {}
+        self.free_rows = list(range(capacity - 1, -1, -1))
+        # currency -> currency id and currency id -> currency
+        self.currency_ids = {}
+        self.currencies = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_currency_id(self, currency):
+        """Get the interned id of a currency, which is assigned once."""
+        currency_id = self.currency_ids.get(currency)
+        if currency_id is None:
+            currency_id = self.currency_ids[currency] = len(self.currencies)
+            self.currencies.append(currency)
+        return currency_id
+
+    def grow(self):
+        """Double the capacity of all columns."""
+        capacity = len(self.valid)
+        for (name, dtype) in self.COLUMNS:
+            column = numpy.zeros(2 * capacity, dtype)
+            column[:capacity] = getattr(self, name)
+            setattr(self, name, column)
+        self.free_rows.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, order):
+        if not self.free_rows:
+            self.grow()
+        row = self.free_rows.pop()
+        self.rows[order.id] = row
+
+        self.order_id[row] = order.id
+        self.timestamp[row] = order.timestamp
+        self.currency_for_sale[row] = \
+            self.get_currency_id(order.currency_for_sale)
+        self.currency_desired[row] = \
+            self.get_currency_id(order.currency_desired)
+        self.valid[row] = True
+        self.update(order)
+
+    def update(self, order):
+        row = self.rows[order.id]
+        self.amount_for_sale[row] = order.amount_for_sale
+        self.amount_desired[row] = order.amount_desired
+        self.unit_price[row] = \
+            float(order.amount_desired) / float(order.amount_for_sale)
+
+    def remove(self, order):
+        row = self.rows.pop(order.id)
+        self.valid[row] = False
+        self.free_rows.append(row)
+
+    def get_exposure(self):
+        """Get the total amount for sale of each currency.
+
+        Returns a dict with currency and amount."""
+        valid = self.valid
+        currency_ids = self.currency_for_sale[valid]
+        if not len(currency_ids):
+            return {}
+
+        # amounts are summed as integers, to keep them exact
+        order = numpy.argsort(currency_ids, kind="mergesort")
+        currency_ids = currency_ids[order]
+        amounts = self.amount_for_sale[valid][order]
+        starts = numpy.flatnonzero(
+            numpy.r_[True, currency_ids[1:] != currency_ids[:-1]])
+        totals = numpy.add.reduceat(amounts, starts)
+
+        return dict((self.currencies[currency_ids[start]], long(total))
+                    for (start, total) in zip(starts, totals))
+
+    def get_pair_mask(self, currency_for_sale, currency_desired):
+        """Get a mask of the rows of open orders with the currency pair."""
+        if currency_for_sale not in self.currency_ids or \
+                currency_desired not in self.currency_ids:
+            return numpy.zeros(len(self.valid), "bool")
+        return self.valid \
+            & (self.currency_for_sale == self.currency_ids[currency_for_sale]) \
+            & (self.currency_desired == self.currency_ids[currency_desired])
+
+    def get_orders_near_best(self, currency_for_sale, currency_desired,
+                             percent):
+        """Get the ids of orders priced within percent of the best price.
+
+        The ids are sorted by unit price."""
+        mask = self.get_pair_mask(currency_for_sale, currency_desired)
+        unit_prices = self.unit_price[mask]
+        if not len(unit_prices):
+            return []
+
+        limit = unit_prices.min() * (1.0 + percent / 100.0)
+        selected = unit_prices <= limit
+        order = numpy.argsort(unit_prices[selected], kind="mergesort")
+        return [long(order_id)
+                for order_id in self.order_id[mask][selected][order]]
+
+    def get_amount_for_sale(self, currency_for_sale, currency_desired):
+        """Get the total amount for sale of a currency pair."""
+        mask = self.get_pair_mask(currency_for_sale, currency_desired)
+        return long(self.amount_for_sale[mask].sum())
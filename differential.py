@@ -0,0 +1,276 @@
+import argparse
+import random
+import sys
+
+from simple_order_matching import Order, Orderbook, MatchingEngine
+from reference import ReferenceOrder, ReferenceEngine
+
+# the differential harness feeds the same randomized streams of orders,
+# cancels and block heights to the frozen reference engine and to the
+# optimized MatchingEngine and compares the complete event traces step
+# by step. on the first divergence the stream is reduced by delta
+# debugging to a small stream with a divergence, which is printed as
+# reproducer.
+#
+# a stream is a list of actions:
+#
+#   ("order", label, (currency for sale, amount for sale, currency
+#    desired, amount desired, timestamp, expiry))
+#   ("cancel", label)
+#   ("advance", block height)
+#
+# labels name the orders of a stream, so actions can be removed from a
+# stream without renumbering. cancels of unknown or closed orders have
+# no effect.
+
+# events and the number of their leading arguments, which are orders
+TRACED_EVENTS = [
+    (MatchingEngine.onOrderArrival, 1),
+    (MatchingEngine.onTrade, 2),
+    (Orderbook.onListing, 1),
+    (Orderbook.onDelisting, 1),
+    (Order.onPendingAmountUpdate, 1),
+    (Order.onUpdatedOrder, 1),
+    (Order.onStatusUpdate, 1),
+]
+
+# (name, validate) of the compared modes of the MatchingEngine
+MODES = [
+    ("validate", True),
+    ("fast", False),
+]
+
+
+def generate_stream(rng, count, currencies=3, prices=4, scale=1000,
+                    cancel_ratio=0.1, advance_ratio=0.05, expiry_ratio=0.2):
+    """Generate a random stream of actions.
+
+    Unit prices are drawn from a few ratios and timestamps repeat, so
+    equal prices, ties and partial fills are common."""
+    names = ["C%i" % i for i in range(currencies)]
+    ratios = [(rng.randint(1, 9), rng.randint(1, 9)) for _ in range(prices)]
+    stream = []
+    labels = []
+    height = 0
+
+    for i in range(count):
+        choice = rng.random()
+        if choice < cancel_ratio and labels:
+            stream.append(("cancel", rng.choice(labels)))
+        elif choice < cancel_ratio + advance_ratio:
+            height += rng.randint(0, 3)
+            stream.append(("advance", height))
+        else:
+            (currency_for_sale, currency_desired) = rng.sample(names, 2)
+            (numerator, denominator) = rng.choice(ratios)
+            amount_for_sale = rng.randint(1, scale)
+            # the inverse ratio on one side, so the prices cross
+            if currency_for_sale < currency_desired:
+                (numerator, denominator) = (denominator, numerator)
+            amount_desired = max(
+                1, amount_for_sale * numerator // denominator
+                + rng.randint(-1, 1))
+            expiry = None
+            if rng.random() < expiry_ratio:
+                expiry = height + rng.randint(0, 5)
+            label = len(labels)
+            labels.append(label)
+            stream.append(("order", label, (
+                currency_for_sale, amount_for_sale, currency_desired,
+                amount_desired, i // 3, expiry)))
+
+    return stream
+
+
+def trace_reference(stream):
+    """Run a stream with the reference engine and return its trace."""
+    engine = ReferenceEngine()
+    for action in stream:
+        if action[0] == "order":
+            (_, label, payload) = action
+            engine.add_order(ReferenceOrder(label, *payload))
+        elif action[0] == "cancel":
+            engine.cancel_order(action[1])
+        else:
+            engine.advance_to(action[1])
+    return engine.trace
+
+
+def trace_engine(stream, validate=True):
+    """Run a stream with the MatchingEngine and return its trace.
+
+    An exception is recorded as ("error", exception) and ends the
+    trace."""
+    trace = []
+    # order id -> label
+    labels = {}
+    # label -> Order
+    orders = {}
+
+    def get_handler(name, order_count):
+        def handler(*args):
+            order = args[0]
+            others = tuple(labels[other.id] for other in args[1:order_count])
+            trace.append((name, labels[order.id], order.status,
+                          order.amount_for_sale, order.amount_desired)
+                         + others + tuple(args[order_count:]))
+        return handler
+
+    handlers = [(event, get_handler(event.name, order_count))
+                for (event, order_count) in TRACED_EVENTS]
+    for (event, handler) in handlers:
+        event += handler
+
+    try:
+        engine = MatchingEngine(validate)
+        for action in stream:
+            if action[0] == "order":
+                (_, label, payload) = action
+                (currency_for_sale, amount_for_sale, currency_desired,
+                 amount_desired, timestamp, expiry) = payload
+                order = Order(currency_for_sale, amount_for_sale,
+                              currency_desired, amount_desired,
+                              timestamp, 0, expiry)
+                labels[order.id] = label
+                orders[label] = order
+                engine.add_order(order)
+            elif action[0] == "cancel":
+                order = orders.get(action[1])
+                if order is not None:
+                    engine.cancel_order(order.id)
+            else:
+                engine.advance_to(action[1])
+    except Exception as e:
+        trace.append(("error", repr(e)))
+    finally:
+        for (event, handler) in handlers:
+            event -= handler
+
+    return trace
+
+
+def find_divergence(expected, actual):
+    """Get the index of the first differing trace entry or None."""
+    for (index, (entry_expected, entry_actual)) in \
+            enumerate(zip(expected, actual)):
+        if entry_expected != entry_actual:
+            return index
+    if len(expected) != len(actual):
+        return min(len(expected), len(actual))
+    return None
+
+
+def diverges(stream, validate=True):
+    return find_divergence(trace_reference(stream),
+                           trace_engine(stream, validate)) is not None
+
+
+def minimize(stream, failing):
+    """Reduce a stream, for which failing(stream) is true.
+
+    Chunks of actions are removed as long as the stream still fails,
+    starting with halves and ending with single actions. Returns a
+    stream, from which no single action can be removed."""
+    chunks = 2
+    while len(stream) >= 2:
+        size = max(1, len(stream) // chunks)
+        reduced = False
+        start = 0
+        while start < len(stream):
+            candidate = stream[:start] + stream[start + size:]
+            if candidate and failing(candidate):
+                stream = candidate
+                reduced = True
+            else:
+                start += size
+        if reduced:
+            chunks = max(chunks - 1, 2)
+        elif size == 1:
+            break
+        else:
+            chunks = min(chunks * 2, len(stream))
+    return stream
+
+
+def format_reproducer(stream, validate=True):
+    """Format a stream as Python code for the MatchingEngine."""
+    lines = [
+        "from simple_order_matching import Order, MatchingEngine",
+        "",
+        "engine = MatchingEngine(validate=%r)" % validate,
+        "orders = {}",
+    ]
+    labels = set()
+    for action in stream:
+        if action[0] == "order":
+            (_, label, payload) = action
+            labels.add(label)
+            lines.append("orders[%r] = engine.add_order(Order(%s))" % (
+                label, ", ".join(repr(value) for value in payload[:5])
+                + ", expiry=%r" % (payload[5], )))
+        elif action[0] == "cancel":
+            # cancels of unknown orders have no effect
+            if action[1] in labels:
+                lines.append(
+                    "engine.cancel_order(orders[%r].id)" % action[1])
+        else:
+            lines.append("engine.advance_to(%r)" % action[1])
+    return "\n".join(lines)
+
+
+def check(seeds, count, modes=MODES):
+    """Compare the engines with one stream per seed.
+
+    Returns None or a dict with the seed, the mode, the minimized
+    stream and the expected and actual trace entry of the first
+    divergence of the minimized stream."""
+    for seed in seeds:
+        stream = generate_stream(random.Random(seed), count)
+        expected = trace_reference(stream)
+
+        for (mode, validate) in modes:
+            if find_divergence(
+                    expected, trace_engine(stream, validate)) is None:
+                continue
+
+            stream = minimize(
+                stream, lambda candidate: diverges(candidate, validate))
+            expected = trace_reference(stream)
+            actual = trace_engine(stream, validate)
+            index = find_divergence(expected, actual)
+            return {
+                "seed": seed,
+                "mode": mode,
+                "stream": stream,
+                "index": index,
+                "expected": expected[index] if index < len(expected) else None,
+                "actual": actual[index] if index < len(actual) else None,
+                "reproducer": format_reproducer(stream, validate),
+            }
+
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the matching engine with the reference engine.")
+    parser.add_argument("--seeds", type=int, default=200,
+                        help="number of random streams")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--actions", type=int, default=300,
+                        help="number of actions per stream")
+    args = parser.parse_args()
+
+    result = check(range(args.first_seed, args.first_seed + args.seeds),
+                   args.actions)
+    if result is None:
+        print("no divergence in %i streams" % args.seeds)
+        sys.exit(0)
+
+    print("divergence with seed %i in %s mode at trace entry %i" % (
+        result["seed"], result["mode"], result["index"]))
+    print("expected: %r" % (result["expected"], ))
+    print("actual:   %r" % (result["actual"], ))
+    print("")
+    print(result["reproducer"])
+    sys.exit(1)
@@ -1,7 +1,39 @@
+import sys
+import threading
+import timeit
+import traceback
+import weakref
+import Queue
+
+# firing an event, which has no handlers and isn't recorded, does 
+# nothing, so the callers may skip preparing its arguments, if the 
+# event is false:
+#
+#   if onTrade:
+#       onTrade(...)
+#
+# handlers are called synchronously by default. with an AsyncDispatcher 
+# they are called by a background thread instead, so slow handlers 
+# don't stall the thread, which fires the events. arguments, which can
+# be copied via __copy__, such as orders, are copied when the event is
+# fired, so the background thread sees them in the state at that time.
+#
+# the handlers of an Event are kept alive by the Event. bound methods,
+# which are added with add_weak, don't keep their object alive and are
+# removed, once the object is collected.
+
+
 class Event(object):
 
-    def __init__(self):
+    def __init__(self, name=None):
+        self.name = name
         self.__handlers = []
+        self.__recorder = None
+        self.__forward = True
+        self.__observer = None
+        self.__dispatcher = None
+        # set, once the object of a weak handler is collected
+        self.__collected = False
 
     def __iadd__(self, handler):
         self.__handlers.append(handler)
@@ -11,12 +43,235 @@ class Event(object):
         self.__handlers.remove(handler)
         return self
 
-    def __call__(self, *args, **kwargs):
-        self.fire(*args, **kwargs)
+    def __len__(self):
+        return len(self.__handlers)
+
+    def __nonzero__(self):
+        """Determine, if firing the event has any effect."""
+        return bool(self.__handlers) or self.__recorder is not None
+
+    __bool__ = __nonzero__
 
     def fire(self, *args, **keywargs):
+        if self.__recorder is not None:
+            self.__recorder((self.name, args))
+            if not self.__forward:
+                return
+        if not self.__handlers:
+            return
+        if self.__dispatcher is not None:
+            self.__dispatcher.put(self, args, keywargs)
+            return
+        self.call_handlers(args, keywargs)
+
+    __call__ = fire
+
+    def add_weak(self, method):
+        """Add a bound method as handler, without keeping its object
+        alive.
+
+        Returns the WeakHandler, which can be removed with -=."""
+        handler = WeakHandler(method, self.__set_collected)
+        self.__handlers.append(handler)
+        return handler
+
+    def __set_collected(self):
+        # called by the garbage collector, so the handlers are only 
+        # removed with the next call
+        self.__collected = True
+
+    def __remove_collected(self):
+        self.__collected = False
+        self.__handlers = [handler for handler in self.__handlers
+                           if not isinstance(handler, WeakHandler)
+                           or handler.is_alive()]
+
+    def call_handlers(self, args, keywargs):
+        if self.__collected:
+            self.__remove_collected()
+        if self.__observer is not None:
+            self.__call_observed(args, keywargs)
+            return
+        for handler in self.__handlers:
+            handler(*args, **keywargs)
+
+    def __call_observed(self, args, keywargs):
+        timer = timeit.default_timer
         for handler in self.__handlers:
+            start = timer()
             handler(*args, **keywargs)
+            self.__observer(self.name, handler, timer() - start)
+
+    def record(self, recorder, forward=False):
+        """Pass fired events as (name, args) tuples to recorder.
+
+        Handlers are only called in addition, if forward is set."""
+        assert self.__recorder is None
+        self.__recorder = recorder
+        self.__forward = forward
+
+    def stop_recording(self):
+        self.__recorder = None
+        self.__forward = True
+
+    def observe(self, observer):
+        """Pass name, handler and duration in seconds of each handler 
+        call to observer."""
+        assert self.__observer is None
+        self.__observer = observer
+
+    def stop_observing(self):
+        self.__observer = None
+
+    def dispatch(self, dispatcher):
+        """Let dispatcher call the handlers instead of calling them 
+        directly."""
+        assert self.__dispatcher is None
+        self.__dispatcher = dispatcher
+
+    def stop_dispatching(self):
+        self.__dispatcher = None
 
     def clearAllHandlers(self):        
-        self.__handlers = []
\ No newline at end of file
+        self.__handlers = []
+
+
+class WeakHandler(object):
+    """Calls a bound method, as long as its object is alive."""
+    __slots__ = ['owner', 'function']
+
+    def __init__(self, method, collected=None):
+        # the callback gets the reference, which is ignored
+        callback = None
+        if collected is not None:
+            callback = lambda reference: collected()
+        self.owner = weakref.ref(method.__self__, callback)
+        self.function = method.__func__
+
+    def __call__(self, *args, **keywargs):
+        owner = self.owner()
+        if owner is not None:
+            self.function(owner, *args, **keywargs)
+
+    def is_alive(self):
+        return self.owner() is not None
+
+
+class EventBatch(object):
+    """Collects the events fired by several Events within a block.
+
+    The fired events are stored as (name, args) tuples in the order 
+    they were fired:
+
+        with EventBatch(events) as batch:
+            ...
+        handle(batch.records)
+    """
+
+    def __init__(self, events, forward=False):
+        self.events = events
+        self.forward = forward
+        self.records = []
+
+    def __enter__(self):
+        for event in self.events:
+            event.record(self.records.append, self.forward)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for event in self.events:
+            event.stop_recording()
+        return False
+
+
+def copy_argument(value):
+    """Copy an argument, which provides __copy__."""
+    copy = getattr(type(value), "__copy__", None)
+    if copy is None:
+        return value
+    return copy(value)
+
+
+class AsyncDispatcher(object):
+    """Calls the handlers of several Events in a background thread.
+
+    Fired events are passed to the thread through a queue with up to 
+    maxsize events. If the queue is full, the firing thread is blocked 
+    with the policy BLOCK, or the event is dropped and counted with the 
+    policy DROP:
+
+        with AsyncDispatcher(events, policy=AsyncDispatcher.DROP):
+            ...
+
+    Arguments with a __copy__ method, such as orders, are copied when
+    the event is fired, so the handlers see them in the state at that
+    time, but not the objects themselves. Other mutable arguments are
+    passed as they are and may have changed since the event was fired.
+    Exceptions of handlers are printed and counted, but don't stop the
+    thread."""
+
+    BLOCK = "block"
+    DROP = "drop"
+
+    def __init__(self, events, maxsize=10000, policy=BLOCK):
+        assert policy in (self.BLOCK, self.DROP)
+        self.events = events
+        self.policy = policy
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+        for event in self.events:
+            event.dispatch(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def put(self, event, args, keywargs):
+        args = tuple(copy_argument(value) for value in args)
+        if keywargs:
+            keywargs = dict((key, copy_argument(value))
+                            for (key, value) in keywargs.items())
+        item = (event, args, keywargs)
+        if self.policy == self.BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                (event, args, keywargs) = item
+                event.call_handlers(args, keywargs)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until the handlers of all queued events were called."""
+        self.queue.join()
+
+    def close(self):
+        """Call the handlers of all queued events and stop the thread.
+
+        Events fired afterwards are handled synchronously again."""
+        for event in self.events:
+            event.stop_dispatching()
+        self.queue.put(None)
+        self.thread.join()
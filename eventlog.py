@@ -0,0 +1,281 @@
+import struct
+import sys
+
+from simple_order_matching import Orderbook, Order, MatchingEngine
+
+# the event log stores the events of the matching engine as fixed-size
+# binary records, so no formatting is done while matching. the records
+# are collected in a buffer and written in large chunks.
+#
+# each record describes the state of one order at the time the event
+# was fired, plus two values and the id of another order, depending on
+# the event:
+#
+#   ORDER_ARRIVAL, LISTING, DELISTING, NEW_ORDER   -
+#   PENDING_UPDATE     new amount for sale, new amount desired
+#   UPDATED_ORDER      amount received, amount spent
+#   STATUS_UPDATE      new status
+#   TRADE              amount to the order, amount to the other order
+#
+# currencies are referred to by ids, which are defined by CURRENCY
+# records of the same size before their first use. the name of a
+# currency is either a string or the decimal representation of an
+# integer currency.
+#
+# the log is decoded offline into (event name, arguments) tuples, as
+# they are collected by event.EventBatch, whereby the orders are
+# recreated from the records.
+
+CURRENCY = 0
+ORDER_ARRIVAL = 1
+TRADE = 2
+LISTING = 3
+DELISTING = 4
+NEW_ORDER = 5
+PENDING_UPDATE = 6
+UPDATED_ORDER = 7
+STATUS_UPDATE = 8
+
+EVENT_NAMES = {
+    ORDER_ARRIVAL: "onOrderArrival",
+    TRADE: "onTrade",
+    LISTING: "onListing",
+    DELISTING: "onDelisting",
+    NEW_ORDER: "onNewOrder",
+    PENDING_UPDATE: "onPendingAmountUpdate",
+    UPDATED_ORDER: "onUpdatedOrder",
+    STATUS_UPDATE: "onStatusUpdate",
+}
+
+# type, status, currency for sale, currency desired, order id,
+# timestamp, amount for sale, amount desired, initial amount desired,
+# first value, second value, other order id
+RECORD = struct.Struct("!BBIIqqqqqqqq")
+# type, kind of currency, currency id, name
+CURRENCY_RECORD = struct.Struct("!BBI%ds" % (RECORD.size - 6))
+
+CURRENCY_STR = 0
+CURRENCY_INT = 1
+
+NO_ORDER = -1
+
+
+class EventLog(object):
+    """Writes the events of the matching engine to a binary file.
+
+    The records are written, once buffer_size bytes are collected, and
+    when the log is flushed or closed:
+
+        with EventLog("events.log"):
+            engine.add_order(order)
+    """
+
+    def __init__(self, path, buffer_size=1 << 20):
+        self.file = open(path, "wb")
+        self.buffer = bytearray(buffer_size - buffer_size % RECORD.size)
+        self.offset = 0
+        # currency -> currency id
+        self.currencies = {}
+
+        self.handlers = [
+            (MatchingEngine.onOrderArrival, self.order_arrival_callback),
+            (MatchingEngine.onTrade, self.trade_execution_callback),
+            (Orderbook.onListing, self.listed_order_callback),
+            (Orderbook.onDelisting, self.delisted_order_callback),
+            (Order.onNewOrder, self.order_created_callback),
+            (Order.onPendingAmountUpdate, self.pending_update_callback),
+            (Order.onUpdatedOrder, self.updated_order_callback),
+            (Order.onStatusUpdate, self.status_update_callback),
+        ]
+        for (event, handler) in self.handlers:
+            event += handler
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def get_currency_id(self, currency):
+        """Get the id of a currency and define it with the first use."""
+        currency_id = self.currencies.get(currency)
+        if currency_id is None:
+            currency_id = self.currencies[currency] = len(self.currencies)
+            if isinstance(currency, (int, long)):
+                (kind, name) = (CURRENCY_INT, str(currency))
+            else:
+                if isinstance(currency, unicode):
+                    currency = currency.encode("utf-8")
+                (kind, name) = (CURRENCY_STR, currency)
+            if len(name) > CURRENCY_RECORD.size - 6:
+                raise ValueError("currency name is too long: %r" % name)
+            self.reserve()
+            CURRENCY_RECORD.pack_into(
+                self.buffer, self.offset, CURRENCY, kind, currency_id, name)
+            self.offset += CURRENCY_RECORD.size
+        return currency_id
+
+    def reserve(self):
+        """Make sure there is room for another record."""
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def write(self, record_type, order, value_1=0, value_2=0,
+              other_id=NO_ORDER):
+        # the currencies are usually known already
+        currencies = self.currencies
+        if order.currency_for_sale in currencies and \
+                order.currency_desired in currencies:
+            currency_for_sale = currencies[order.currency_for_sale]
+            currency_desired = currencies[order.currency_desired]
+        else:
+            currency_for_sale = self.get_currency_id(order.currency_for_sale)
+            currency_desired = self.get_currency_id(order.currency_desired)
+
+        if self.offset == len(self.buffer):
+            self.flush()
+        RECORD.pack_into(
+            self.buffer, self.offset, record_type, order.status,
+            currency_for_sale, currency_desired, order.id, order.timestamp,
+            order.amount_for_sale, order.amount_desired,
+            order.initial_amount_desired, value_1, value_2, other_id)
+        self.offset += RECORD.size
+
+    def flush(self):
+        """Write all collected records to the file."""
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.file.flush()
+        self.offset = 0
+
+    def close(self):
+        """Stop logging and write the remaining records."""
+        for (event, handler) in self.handlers:
+            event -= handler
+        self.flush()
+        self.file.close()
+
+    def order_arrival_callback(self, order):
+        self.write(ORDER_ARRIVAL, order)
+
+    def trade_execution_callback(self, order_a1, order_a2, amount_to_a1,
+                                 amount_to_a2):
+        self.write(TRADE, order_a1, amount_to_a1, amount_to_a2, order_a2.id)
+
+    def listed_order_callback(self, order):
+        self.write(LISTING, order)
+
+    def delisted_order_callback(self, order):
+        self.write(DELISTING, order)
+
+    def order_created_callback(self, order):
+        self.write(NEW_ORDER, order)
+
+    def pending_update_callback(self, order, new_amount_for_sale,
+                                new_amount_desired):
+        self.write(PENDING_UPDATE, order,
+                   new_amount_for_sale, new_amount_desired)
+
+    def updated_order_callback(self, order, amount_received, amount_spent):
+        self.write(UPDATED_ORDER, order, amount_received, amount_spent)
+
+    def status_update_callback(self, order, status):
+        self.write(STATUS_UPDATE, order, status)
+
+
+def create_order(order_id, timestamp, status, currency_for_sale,
+                 amount_for_sale, currency_desired, amount_desired,
+                 initial_amount_desired):
+    """Recreate the state of a logged order.
+
+    Unlike Order.restore, the ids of new orders are not affected."""
+    order = Order.__new__(Order)
+    order.id = order_id
+    order.timestamp = timestamp
+    order.status = status
+    order.expiry = None
+    order.currency_for_sale = currency_for_sale
+    order.amount_for_sale = long(amount_for_sale)
+    order.initial_amount_for_sale = long(amount_for_sale)
+    order.currency_desired = currency_desired
+    order.amount_desired = long(amount_desired)
+    order.initial_amount_desired = long(initial_amount_desired)
+    order.price_key = None
+    return order
+
+
+def read_event_log(path, chunk_size=1 << 20):
+    """Decode an event log.
+
+    Yields (event name, arguments) tuples in the order the events were
+    fired. An incomplete record at the end is ignored."""
+    # currency id -> currency
+    currencies = {}
+    chunk_size -= chunk_size % RECORD.size
+
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if len(data) < RECORD.size:
+                break
+
+            for offset in range(0, len(data) - RECORD.size + 1, RECORD.size):
+                if ord(data[offset]) == CURRENCY:
+                    (_, kind, currency_id, name) = \
+                        CURRENCY_RECORD.unpack_from(data, offset)
+                    name = name.rstrip("\0")
+                    if kind == CURRENCY_INT:
+                        name = int(name)
+                    currencies[currency_id] = name
+                    continue
+
+                (record_type, status, currency_for_sale, currency_desired,
+                 order_id, timestamp, amount_for_sale, amount_desired,
+                 initial_amount_desired, value_1, value_2, other_id) = \
+                    RECORD.unpack_from(data, offset)
+
+                order = create_order(
+                    order_id, timestamp, status,
+                    currencies[currency_for_sale], amount_for_sale,
+                    currencies[currency_desired], amount_desired,
+                    initial_amount_desired)
+
+                if record_type == TRADE:
+                    # only the id and currency desired of the other order
+                    # are known
+                    other = create_order(
+                        other_id, timestamp, status,
+                        order.currency_desired, 0,
+                        order.currency_for_sale, 0, 0)
+                    args = (order, other, long(value_1), long(value_2))
+                elif record_type in (PENDING_UPDATE, UPDATED_ORDER):
+                    args = (order, long(value_1), long(value_2))
+                elif record_type == STATUS_UPDATE:
+                    args = (order, value_1)
+                else:
+                    args = (order, )
+
+                yield (EVENT_NAMES[record_type], args)
+
+
+if __name__ == "__main__":
+    # renders an event log with the sample view of main.py
+    from main import SampleView
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: python eventlog.py <event log>")
+
+    view = SampleView()
+    callbacks = {
+        "onOrderArrival": view.order_arrival_callback,
+        "onTrade": view.trade_execution_callback,
+        "onListing": view.listed_order_callback,
+        "onDelisting": view.delisted_order_callback,
+        "onNewOrder": view.order_created_callback,
+        "onPendingAmountUpdate": view.pending_update_callback,
+        "onUpdatedOrder": view.updated_order_callback,
+        "onStatusUpdate": view.status_update_callback,
+    }
+
+    for (name, args) in read_event_log(sys.argv[1]):
+        callbacks[name](*args)
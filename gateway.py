@@ -0,0 +1,572 @@
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import Queue
+import SocketServer
+
+import event
+from simple_order_matching import OrderStatus, Order, MatchingEngine
+from snapshots import SnapshotPublisher
+
+# orders are received over TCP or Unix sockets from many clients, but
+# only a single thread feeds them into the matching engine. requests
+# are passed to this thread through a bounded queue, so clients are
+# blocked, if the engine falls behind. responses are sent to each
+# client by a separate thread through a bounded queue. the engine never
+# waits for a client: a client, which doesn't read its responses and
+# lets its queue fill up, is disconnected.
+#
+# requests are either newline-delimited JSON objects:
+#
+#   {"type": "order", "currency_for_sale": "MSC", "amount_for_sale": 5,
+#    "currency_desired": "BTC", "amount_desired": 1, "timestamp": 7}
+#   {"type": "cancel", "order_id": 3}
+#
+# or binary frames, which start with the frame type:
+#
+#   order:  ORDER_HEADER, currency for sale, currency desired
+#   cancel: CANCEL_FRAME
+#
+# a client is answered in the format of its last request. responses
+# are JSON objects with "type", "order_id", "received" and "spent", or
+# RESPONSE_FRAME records. each request is finally answered with exactly
+# one of LISTED, FILLED, CANCELED or REJECTED on the session, which
+# sent it. orders can only be canceled by the session, which submitted
+# them.
+
+FRAME_ORDER = 1
+FRAME_CANCEL = 2
+
+# type, length of currency for sale, length of currency desired,
+# amount for sale, amount desired, timestamp (negative if unknown)
+ORDER_HEADER = struct.Struct("!BBBqqq")
+# type, order id
+CANCEL_FRAME = struct.Struct("!Bq")
+# type, order id, amount received, amount spent
+RESPONSE_FRAME = struct.Struct("!Bqqq")
+
+ACCEPTED = 1
+REJECTED = 2
+FILL = 3
+FILLED = 4
+LISTED = 5
+CANCELED = 6
+
+RESPONSE_TYPES = {
+    ACCEPTED: "accepted",
+    REJECTED: "rejected",
+    FILL: "fill",
+    FILLED: "filled",
+    LISTED: "listed",
+    CANCELED: "canceled",
+}
+RESPONSE_CODES = dict((v, k) for (k, v) in RESPONSE_TYPES.items())
+
+# amounts and timestamps must fit into the signed 64-bit integers of the
+# binary frames
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool) \
+        and 0 <= value <= MAX_INTEGER
+
+
+def check_order(currency_for_sale, amount_for_sale,
+                currency_desired, amount_desired, timestamp=None):
+    """Determine, if the arguments of a requested order are valid.
+
+    Requests are checked explicitly instead of relying on the 
+    assertions of Order, which are skipped with python -O."""
+    for currency in (currency_for_sale, currency_desired):
+        if not isinstance(currency, (str, unicode)):
+            return False
+    for amount in (amount_for_sale, amount_desired):
+        if not is_integer(amount) or amount == 0:
+            return False
+    if timestamp is not None and not is_integer(timestamp):
+        return False
+    return currency_for_sale != currency_desired
+
+
+def encode_order(currency_for_sale, amount_for_sale,
+                 currency_desired, amount_desired, timestamp=None):
+    """Encode an order as binary frame."""
+    if timestamp is None:
+        timestamp = -1
+    return ORDER_HEADER.pack(
+        FRAME_ORDER, len(currency_for_sale), len(currency_desired),
+        amount_for_sale, amount_desired, timestamp) \
+        + currency_for_sale + currency_desired
+
+
+def encode_cancel(order_id):
+    """Encode a cancellation as binary frame."""
+    return CANCEL_FRAME.pack(FRAME_CANCEL, order_id)
+
+
+def read_request(stream):
+    """Read and decode one request.
+
+    Returns a tuple of the request, which is either ("order",
+    arguments of Order) or ("cancel", order id), and a flag, whether
+    the request was binary. Returns None at the end of the stream."""
+    first = stream.read(1)
+    if not first:
+        return None
+
+    if first == "{":
+        message = json.loads(first + stream.readline())
+        if message["type"] == "order":
+            request = ("order", (
+                message["currency_for_sale"], message["amount_for_sale"],
+                message["currency_desired"], message["amount_desired"],
+                message.get("timestamp")))
+        elif message["type"] == "cancel":
+            request = ("cancel", message["order_id"])
+        else:
+            raise ValueError("unknown request type %r" % message["type"])
+        return (request, False)
+
+    if ord(first) == FRAME_ORDER:
+        (_, length_for_sale, length_desired, amount_for_sale,
+         amount_desired, timestamp) = ORDER_HEADER.unpack(
+            first + stream.read(ORDER_HEADER.size - 1))
+        currency_for_sale = stream.read(length_for_sale)
+        currency_desired = stream.read(length_desired)
+        if timestamp < 0:
+            timestamp = None
+        request = ("order", (currency_for_sale, amount_for_sale,
+                             currency_desired, amount_desired, timestamp))
+        return (request, True)
+
+    if ord(first) == FRAME_CANCEL:
+        (_, order_id) = CANCEL_FRAME.unpack(
+            first + stream.read(CANCEL_FRAME.size - 1))
+        return (("cancel", order_id), True)
+
+    raise ValueError("unknown frame type %i" % ord(first))
+
+
+def encode_response(response, binary):
+    """Encode a (type, order id, received, spent) response."""
+    if binary:
+        return RESPONSE_FRAME.pack(*response)
+    (response_type, order_id, received, spent) = response
+    return json.dumps({
+        "type": RESPONSE_TYPES[response_type], "order_id": order_id,
+        "received": received, "spent": spent}) + "\n"
+
+
+class OrderGateway(object):
+    """Serializes requests of many clients into one matching engine.
+
+    If publish_snapshots is set, a snapshot of the orderbook is 
+    published after each request and other threads can read the book 
+    via gateway.snapshots.current without blocking the engine."""
+
+    def __init__(self, engine=None, max_pending=1024,
+                 publish_snapshots=False):
+        if engine is None:
+            engine = MatchingEngine()
+        self.engine = engine
+        self.snapshots = None
+        if publish_snapshots:
+            self.snapshots = SnapshotPublisher(engine.orderbook)
+        self.requests = Queue.Queue(max_pending)
+        # order id -> session of the client, which submitted the order
+        self.owners = {}
+        # number of requests, for which the engine failed
+        self.errors = 0
+        self.events = MatchingEngine.get_batched_events()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, session, request):
+        """Enqueue a request, blocks if too many requests are pending."""
+        self.requests.put((session, request))
+
+    def run(self):
+        """Process enqueued requests until the gateway is stopped."""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            (session, request) = item
+            if request is None:
+                # all requests of a disconnected client were processed
+                session.close()
+            else:
+                self.process(session, request)
+                if self.snapshots is not None:
+                    self.snapshots.publish()
+
+    def process(self, session, request):
+        """Process one request.
+
+        Invalid requests and requests, for which the engine fails, are 
+        answered with REJECTED, whereby the error of the engine is 
+        printed and counted."""
+        (request_type, payload) = request
+
+        if request_type == "order":
+            if not check_order(*payload):
+                session.send((REJECTED, -1, 0, 0))
+                return
+            order = Order(*payload)
+            self.owners[order.id] = session
+            session.send((ACCEPTED, order.id, 0, 0))
+
+            try:
+                with event.EventBatch(self.events) as batch:
+                    self.engine.add_order(order)
+            except Exception:
+                self.reject(session, order.id)
+                return
+        else:
+            if not is_integer(payload):
+                session.send((REJECTED, -1, 0, 0))
+                return
+            # the CANCELED response is sent to the owner
+            if self.owners.get(payload) is not session:
+                session.send((REJECTED, payload, 0, 0))
+                return
+            try:
+                with event.EventBatch(self.events) as batch:
+                    order = self.engine.cancel_order(payload)
+            except Exception:
+                self.reject(session, payload)
+                return
+            if order is None:
+                session.send((REJECTED, payload, 0, 0))
+                return
+
+        self.dispatch(batch.records)
+
+    def reject(self, session, order_id):
+        """Answer a request, for which the engine failed."""
+        self.errors += 1
+        traceback.print_exc(file=sys.stderr)
+        self.owners.pop(order_id, None)
+        session.send((REJECTED, order_id, 0, 0))
+
+    def dispatch(self, records):
+        """Stream the results of a request to the affected clients."""
+        # the status of an order is updated before the traded amounts 
+        # are reported, but clients are informed about the fill first
+        filled = set()
+
+        for (name, args) in records:
+            if name == "onUpdatedOrder":
+                (order, amount_received, amount_spent) = args
+                self.notify(order, FILL, amount_received, amount_spent)
+                if order.id in filled:
+                    filled.remove(order.id)
+                    self.notify(order, FILLED)
+                    self.owners.pop(order.id, None)
+            elif name == "onListing":
+                self.notify(args[0], LISTED)
+            elif name == "onStatusUpdate":
+                (order, status) = args
+                if status == OrderStatus.Filled:
+                    filled.add(order.id)
+                elif status == OrderStatus.Canceled:
+                    self.notify(order, CANCELED)
+                    self.owners.pop(order.id, None)
+
+    def notify(self, order, response_type, received=0, spent=0):
+        session = self.owners.get(order.id)
+        if session is not None:
+            session.send((response_type, order.id, received, spent))
+
+
+class GatewayHandler(SocketServer.StreamRequestHandler):
+    """Session of a connected client."""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.gateway = self.server.gateway
+        self.responses = Queue.Queue(self.server.max_pending)
+        self.binary = False
+        self.closed = False
+        self.sender = threading.Thread(target=self.send_responses)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def handle(self):
+        while True:
+            try:
+                result = read_request(self.rfile)
+            except (ValueError, KeyError, struct.error):
+                break
+            if result is None:
+                break
+            (request, self.binary) = result
+            self.gateway.submit(self, request)
+
+        # the session is closed, once all pending requests are processed
+        self.gateway.submit(self, None)
+        self.sender.join()
+
+    def finish(self):
+        # the connection of a disconnected client is already shut down
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def send(self, response):
+        """Enqueue a response without blocking.
+
+        The client is disconnected, if it doesn't keep up."""
+        if self.closed:
+            return
+        try:
+            self.responses.put_nowait(response)
+        except Queue.Full:
+            self.disconnect()
+
+    def disconnect(self):
+        """Drop further responses and end the session."""
+        self.closed = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.closed = True
+        try:
+            self.responses.put_nowait(None)
+        except Queue.Full:
+            # the sender stops, once it emptied the queue
+            pass
+
+    def send_responses(self):
+        while True:
+            if self.closed and self.responses.empty():
+                break
+            response = self.responses.get()
+            if response is None:
+                break
+            data = encode_response(response, self.binary)
+            # collect further responses to reduce the number of writes
+            try:
+                while len(data) < 65536:
+                    response = self.responses.get_nowait()
+                    if response is None:
+                        self.write(data)
+                        return
+                    data += encode_response(response, self.binary)
+            except Queue.Empty:
+                pass
+            self.write(data)
+
+    def write(self, data):
+        try:
+            self.wfile.write(data)
+            self.wfile.flush()
+        except socket.error:
+            pass
+
+
+class TCPGatewayServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixGatewayServer(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(gateway, address, max_pending=1024):
+    """Create a server for a (host, port) tuple or Unix socket path."""
+    if isinstance(address, tuple):
+        server = TCPGatewayServer(address, GatewayHandler)
+    else:
+        server = UnixGatewayServer(address, GatewayHandler)
+    server.gateway = gateway
+    server.max_pending = max_pending
+    return server
+
+
+class GatewayClient(object):
+    """Simple client to submit orders and read responses."""
+
+    def __init__(self, address, binary=False):
+        if isinstance(address, tuple):
+            self.socket = socket.create_connection(address)
+            self.socket.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        self.rfile = self.socket.makefile("rb")
+        self.binary = binary
+
+    def send_order(self, currency_for_sale, amount_for_sale,
+                   currency_desired, amount_desired, timestamp=None):
+        if self.binary:
+            data = encode_order(
+                currency_for_sale, amount_for_sale,
+                currency_desired, amount_desired, timestamp)
+        else:
+            data = json.dumps({
+                "type": "order",
+                "currency_for_sale": currency_for_sale,
+                "amount_for_sale": amount_for_sale,
+                "currency_desired": currency_desired,
+                "amount_desired": amount_desired,
+                "timestamp": timestamp}) + "\n"
+        self.socket.sendall(data)
+
+    def send_cancel(self, order_id):
+        if self.binary:
+            data = encode_cancel(order_id)
+        else:
+            data = json.dumps({"type": "cancel", "order_id": order_id}) + "\n"
+        self.socket.sendall(data)
+
+    def read_response(self):
+        """Read a response as (type, order id, received, spent) tuple.
+
+        Returns None, if the connection was closed."""
+        if self.binary:
+            data = self.rfile.read(RESPONSE_FRAME.size)
+            if len(data) < RESPONSE_FRAME.size:
+                return None
+            return RESPONSE_FRAME.unpack(data)
+        line = self.rfile.readline()
+        if not line:
+            return None
+        message = json.loads(line)
+        return (RESPONSE_CODES[message["type"]], message["order_id"],
+                message["received"], message["spent"])
+
+    def shutdown(self):
+        """Stop sending, responses can still be read."""
+        self.socket.shutdown(socket.SHUT_WR)
+
+    def close(self):
+        self.rfile.close()
+        self.socket.close()
+
+
+def run_loopback_client(address, orders, binary, latencies):
+    """Submit orders and measure the time until they are listed, filled
+    or rejected."""
+    client = GatewayClient(address, binary)
+    sent = []
+
+    def submit():
+        for order in orders:
+            sent.append(time.time())
+            client.send_order(*order)
+        client.shutdown()
+
+    submitter = threading.Thread(target=submit)
+    submitter.start()
+
+    # requests are answered in order, so the n-th ACCEPTED or REJECTED 
+    # response belongs to the n-th order
+    answered = 0
+    # order id -> time the order was sent, until it is listed or filled
+    pending = {}
+    while True:
+        response = client.read_response()
+        if response is None:
+            break
+        (response_type, order_id) = response[:2]
+        if response_type == ACCEPTED:
+            pending[order_id] = sent[answered]
+            answered += 1
+        elif response_type == REJECTED and order_id not in pending:
+            latencies.append(time.time() - sent[answered])
+            answered += 1
+        elif response_type in (LISTED, FILLED, REJECTED) \
+                and order_id in pending:
+            latencies.append(time.time() - pending.pop(order_id))
+
+    submitter.join()
+    client.close()
+
+
+def measure(clients=4, orders_per_client=5000, binary=False, address=None):
+    """Run a gateway and loopback clients on this machine.
+
+    Returns the number of orders per second and a sorted list of the
+    latencies in seconds from sending an order until it is listed,
+    filled or rejected."""
+    directory = None
+    if address is None:
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, "gateway.sock")
+
+    gateway = OrderGateway(MatchingEngine(validate=False))
+    gateway.start()
+    server = create_server(gateway, address)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    flows = []
+    for i in range(clients):
+        rng = random.Random(i)
+        flow = []
+        for _ in range(orders_per_client):
+            if rng.random() < 0.5:
+                flow.append(("MSC", rng.randint(100, 1000),
+                             "BTC", rng.randint(20, 250)))
+            else:
+                flow.append(("BTC", rng.randint(20, 250),
+                             "MSC", rng.randint(100, 1000)))
+        flows.append(flow)
+
+    latencies = []
+    threads = [threading.Thread(target=run_loopback_client,
+                                args=(address, flow, binary, latencies))
+               for flow in flows]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    server.shutdown()
+    server.server_close()
+    gateway.stop()
+    if directory is not None:
+        os.remove(address)
+        os.rmdir(directory)
+
+    latencies.sort()
+    return (clients * orders_per_client / elapsed, latencies)
+
+
+if __name__ == "__main__":
+    binary = "--binary" in sys.argv
+    (throughput, latencies) = measure(binary=binary)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    print("%.0f orders/s, order to fill or listing p50 %.3f ms, "
+          "p99 %.3f ms" % \
+        (throughput, percentile(0.5) * 1000, percentile(0.99) * 1000))
@@ -0,0 +1,379 @@
+import mmap
+import os
+import struct
+
+import event
+from simple_order_matching import OrderStatus, Order, MatchingEngine
+
+# accepted orders and cancels are appended to a journal, before they
+# are executed. from time to time the open orders are written to a
+# snapshot and a new journal is started, so a restart only needs to load
+# the snapshot and to replay the orders and cancels which came after it.
+#
+# the files in the directory of a JournaledEngine are:
+#
+#   snapshot      open orders, last order id and the journal generation
+#   journal.<n>   orders and cancels after the snapshot of generation n
+#
+# currencies are either strings or integers and stored as CURRENCY_STR
+# followed by the encoded string or as CURRENCY_INT.
+#
+# a journal consists of ORDER_ENTRY or EXPIRING_ORDER_ENTRY records
+# followed by both currencies, CANCEL_ENTRY and ADVANCE_ENTRY records.
+#
+# a snapshot consists of SNAPSHOT_HEADER, SNAPSHOT_HEIGHT, the currency
+# table and one fixed-size SNAPSHOT_ORDER record per open order, in the
+# order the orders were listed. the records refer to currencies by their
+# index in the table, so they can be accessed directly in a
+# memory-mapped file. snapshots of version 1 have no SNAPSHOT_HEIGHT and
+# their records have no expiry.
+#
+# missing block heights and expiries are stored as NO_HEIGHT.
+
+JOURNAL_ORDER = 1
+JOURNAL_CANCEL = 2
+JOURNAL_EXPIRING_ORDER = 3
+JOURNAL_ADVANCE = 4
+
+NO_HEIGHT = -1
+
+CURRENCY_STR = struct.Struct("!BH")
+CURRENCY_INT = struct.Struct("!Bq")
+
+# type, order id, timestamp, amount for sale, amount desired
+ORDER_ENTRY = struct.Struct("!Bqqqq")
+# type, order id, timestamp, amount for sale, amount desired, expiry
+EXPIRING_ORDER_ENTRY = struct.Struct("!Bqqqqq")
+# type, order id
+CANCEL_ENTRY = struct.Struct("!Bq")
+# type, block height
+ADVANCE_ENTRY = struct.Struct("!Bq")
+
+SNAPSHOT_MAGIC = "SOMS"
+SNAPSHOT_VERSION = 2
+
+# magic, version, journal generation, last order id, number of
+# currencies, number of orders
+SNAPSHOT_HEADER = struct.Struct("!4sHQqII")
+# block height, up to which orders were expired
+SNAPSHOT_HEIGHT = struct.Struct("!q")
+# order id, timestamp, status, currency for sale, amount for sale,
+# initial amount for sale, currency desired, amount desired, initial
+# amount desired, expiry
+SNAPSHOT_ORDER = struct.Struct("!qqBIqqIqqq")
+SNAPSHOT_ORDER_V1 = struct.Struct("!qqBIqqIqq")
+
+
+def pack_currency(currency):
+    if isinstance(currency, (int, long)):
+        return CURRENCY_INT.pack(1, currency)
+    if isinstance(currency, unicode):
+        currency = currency.encode("utf-8")
+    return CURRENCY_STR.pack(0, len(currency)) + currency
+
+
+def pack_height(height):
+    if height is None:
+        return NO_HEIGHT
+    return height
+
+
+def unpack_height(height):
+    if height == NO_HEIGHT:
+        return None
+    return height
+
+
+def unpack_currency(data, offset):
+    """Returns the currency and the offset after it."""
+    (kind, length) = CURRENCY_STR.unpack_from(data, offset)
+    if kind == 1:
+        (_, currency) = CURRENCY_INT.unpack_from(data, offset)
+        return (currency, offset + CURRENCY_INT.size)
+    offset += CURRENCY_STR.size
+    currency = data[offset:offset + length]
+    if len(currency) != length:
+        raise struct.error("truncated currency")
+    return (currency, offset + length)
+
+
+class Journal(object):
+    """Append-only log of accepted orders and cancels.
+
+    Entries are synchronized to disk in batches of sync_every entries,
+    so at most the last sync_every - 1 entries are lost on a crash."""
+
+    def __init__(self, path, sync_every=100):
+        self.path = path
+        self.file = open(path, "ab")
+        self.sync_every = sync_every
+        self.pending = 0
+
+    def append_order(self, order):
+        if order.expiry is None:
+            entry = ORDER_ENTRY.pack(
+                JOURNAL_ORDER, order.id, order.timestamp,
+                order.amount_for_sale, order.amount_desired)
+        else:
+            entry = EXPIRING_ORDER_ENTRY.pack(
+                JOURNAL_EXPIRING_ORDER, order.id, order.timestamp,
+                order.amount_for_sale, order.amount_desired, order.expiry)
+        self.append(entry
+                    + pack_currency(order.currency_for_sale)
+                    + pack_currency(order.currency_desired))
+
+    def append_cancel(self, order_id):
+        self.append(CANCEL_ENTRY.pack(JOURNAL_CANCEL, order_id))
+
+    def append_advance(self, height):
+        self.append(ADVANCE_ENTRY.pack(JOURNAL_ADVANCE, height))
+
+    def append(self, data):
+        self.file.write(data)
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """Write all pending entries to disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def read_journal(path):
+    """Read the entries of a journal.
+
+    Returns a list of ("order", Order), ("cancel", order id) and
+    ("advance", block height) tuples and the size of the complete
+    entries. An incomplete entry at the end, e.g. after a crash, is
+    ignored."""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    entries = []
+    offset = 0
+    while offset < len(data):
+        try:
+            entry_type = ord(data[offset])
+            if entry_type in (JOURNAL_ORDER, JOURNAL_EXPIRING_ORDER):
+                if entry_type == JOURNAL_ORDER:
+                    (_, order_id, timestamp, amount_for_sale,
+                     amount_desired) = ORDER_ENTRY.unpack_from(data, offset)
+                    expiry = None
+                    end = offset + ORDER_ENTRY.size
+                else:
+                    (_, order_id, timestamp, amount_for_sale, amount_desired,
+                     expiry) = EXPIRING_ORDER_ENTRY.unpack_from(data, offset)
+                    end = offset + EXPIRING_ORDER_ENTRY.size
+                (currency_for_sale, end) = unpack_currency(data, end)
+                (currency_desired, end) = unpack_currency(data, end)
+                order = Order.restore(
+                    order_id, timestamp, OrderStatus.New,
+                    currency_for_sale, amount_for_sale, amount_for_sale,
+                    currency_desired, amount_desired, amount_desired,
+                    expiry)
+                entries.append(("order", order))
+            elif entry_type == JOURNAL_CANCEL:
+                (_, order_id) = CANCEL_ENTRY.unpack_from(data, offset)
+                end = offset + CANCEL_ENTRY.size
+                entries.append(("cancel", order_id))
+            elif entry_type == JOURNAL_ADVANCE:
+                (_, height) = ADVANCE_ENTRY.unpack_from(data, offset)
+                end = offset + ADVANCE_ENTRY.size
+                entries.append(("advance", height))
+            else:
+                break
+        except struct.error:
+            break
+        offset = end
+
+    return (entries, offset)
+
+
+def write_snapshot(path, orderbook, generation):
+    """Write the open orders to a snapshot file.
+
+    The file is replaced atomically."""
+    orders = list(orderbook.orders.values())
+
+    currencies = {}
+    table = []
+    for order in orders:
+        for currency in (order.currency_for_sale, order.currency_desired):
+            if currency not in currencies:
+                currencies[currency] = len(table)
+                table.append(pack_currency(currency))
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, generation,
+            Order.get_last_id(), len(table), len(orders)))
+        f.write(SNAPSHOT_HEIGHT.pack(pack_height(orderbook.height)))
+        f.write("".join(table))
+        f.write("".join(SNAPSHOT_ORDER.pack(
+            order.id, order.timestamp, order.status,
+            currencies[order.currency_for_sale], order.amount_for_sale,
+            order.initial_amount_for_sale,
+            currencies[order.currency_desired], order.amount_desired,
+            order.initial_amount_desired, pack_height(order.expiry))
+            for order in orders))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary_path, path)
+
+
+def read_snapshot(path):
+    """Read a snapshot file.
+
+    Returns the journal generation, the last order id, the block
+    height, up to which orders were expired, and the list of open
+    orders in the order they were listed."""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version, generation, last_id, currency_count,
+         order_count) = SNAPSHOT_HEADER.unpack_from(data, 0)
+        assert magic == SNAPSHOT_MAGIC
+        assert version in (1, SNAPSHOT_VERSION)
+
+        offset = SNAPSHOT_HEADER.size
+        height = None
+        record = SNAPSHOT_ORDER_V1
+        if version == SNAPSHOT_VERSION:
+            (height, ) = SNAPSHOT_HEIGHT.unpack_from(data, offset)
+            height = unpack_height(height)
+            offset += SNAPSHOT_HEIGHT.size
+            record = SNAPSHOT_ORDER
+
+        table = []
+        for _ in range(currency_count):
+            (currency, offset) = unpack_currency(data, offset)
+            table.append(currency)
+
+        orders = []
+        for _ in range(order_count):
+            values = record.unpack_from(data, offset)
+            (order_id, timestamp, status, currency_for_sale, amount_for_sale,
+             initial_amount_for_sale, currency_desired, amount_desired,
+             initial_amount_desired) = values[:9]
+            expiry = None
+            if len(values) > 9:
+                expiry = unpack_height(values[9])
+            orders.append(Order.restore(
+                order_id, timestamp, status,
+                table[currency_for_sale], amount_for_sale,
+                initial_amount_for_sale,
+                table[currency_desired], amount_desired,
+                initial_amount_desired, expiry))
+            offset += record.size
+    finally:
+        data.close()
+
+    return (generation, last_id, height, orders)
+
+
+class JournaledEngine(object):
+    """Matching engine, which can be restored after a restart.
+
+    Orders and cancels are journaled before they are executed. On
+    startup the latest snapshot is loaded and the journal after it is
+    replayed. No events are fired while the engine is restored."""
+
+    def __init__(self, directory, sync_every=100, validate=True):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.engine = MatchingEngine(validate)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.generation = self.restore()
+        self.journal = Journal(
+            self.get_journal_path(self.generation), sync_every)
+
+    def get_journal_path(self, generation):
+        return os.path.join(self.directory, "journal.%i" % generation)
+
+    def get_snapshot_path(self):
+        return os.path.join(self.directory, "snapshot")
+
+    def restore(self):
+        """Load the latest snapshot and replay the journal after it.
+
+        Returns the generation of the journal."""
+        generation = 0
+
+        with event.EventBatch(MatchingEngine.get_batched_events()) as batch:
+            if os.path.exists(self.get_snapshot_path()):
+                (generation, last_id, height, orders) = \
+                    read_snapshot(self.get_snapshot_path())
+                Order.reserve_id(last_id)
+                for order in orders:
+                    self.engine.orderbook.list(order)
+                if height is not None:
+                    self.engine.advance_to(height)
+                del batch.records[:]
+
+            journal_path = self.get_journal_path(generation)
+            if os.path.exists(journal_path):
+                (entries, size) = read_journal(journal_path)
+                for (entry_type, entry) in entries:
+                    if entry_type == "order":
+                        self.engine.add_order(entry)
+                    elif entry_type == "cancel":
+                        self.engine.cancel_order(entry)
+                    else:
+                        self.engine.advance_to(entry)
+                    # the events of the replay are not needed
+                    del batch.records[:]
+
+                # drop an incomplete entry, so new entries can follow
+                if size < os.path.getsize(journal_path):
+                    with open(journal_path, "r+b") as f:
+                        f.truncate(size)
+
+        return generation
+
+    def add_order(self, order):
+        """Journal and add an order.
+
+        Returns Order after execution or listing."""
+        self.journal.append_order(order)
+        return self.engine.add_order(order)
+
+    def cancel_order(self, order_id):
+        """Journal and cancel an open order.
+
+        Returns the canceled Order or None, if there is no open order
+        with the given id."""
+        self.journal.append_cancel(order_id)
+        return self.engine.cancel_order(order_id)
+
+    def advance_to(self, height):
+        """Journal the block height and expire the orders due by it.
+
+        Returns the list of expired Orders."""
+        self.journal.append_advance(height)
+        return self.engine.advance_to(height)
+
+    def snapshot(self):
+        """Write the open orders to a snapshot and start a new journal."""
+        self.journal.sync()
+        write_snapshot(
+            self.get_snapshot_path(), self.engine.orderbook,
+            self.generation + 1)
+
+        self.journal.close()
+        os.remove(self.get_journal_path(self.generation))
+        self.generation += 1
+        self.journal = Journal(
+            self.get_journal_path(self.generation), self.sync_every)
+
+    def close(self):
+        self.journal.close()
@@ -0,0 +1,294 @@
+import collections
+import functools
+import inspect
+import json
+import sys
+import timeit
+
+from simple_order_matching import Orderbook, Order, MatchingEngine
+
+# the profiler measures the stages of the matching engine by replacing
+# the methods below with timed wrappers, while it is enabled. the
+# original methods are restored afterwards, so there is no cost at all,
+# when the profiler is not used. stages of all engines are measured and
+# the time of a stage includes the stages called from it. overrides of a
+# stage in subclasses, e.g. BatchAuctionEngine.add_order, are wrapped as
+# well and counted as the stage of the base class. only subclasses, which
+# are defined when the profiler is enabled, are measured.
+#
+# the handlers of events are timed via Event.observe, whereby the
+# slowest handler of each event is kept.
+#
+# durations are counted in buckets of powers of two nanoseconds, so the
+# percentiles of a histogram are upper bounds, which are at most twice
+# the real value.
+
+STAGES = [
+    (MatchingEngine, "add_order"),
+    (MatchingEngine, "get_best_match"),
+    (Orderbook, "get_best_order"),
+    (Order, "matches_with"),
+    (Order, "accepts_price_of"),
+    (MatchingEngine, "get_traded_amounts"),
+    (MatchingEngine, "calculate_traded_amounts"),
+    (MatchingEngine, "execute_orders"),
+    (Order, "update_order"),
+    (Orderbook, "list"),
+    (Orderbook, "delist"),
+    (Orderbook, "refresh"),
+]
+
+
+def get_stage_name(cls, name):
+    return "%s.%s" % (cls.__name__, name)
+
+
+def get_overrides(cls, name):
+    """Get the class and all loaded subclasses, which define the method.
+
+    The engine classes are old-style classes without __subclasses__, so
+    the subclasses are searched in the loaded modules."""
+    classes = [cls]
+    for module in list(sys.modules.values()):
+        for value in list(getattr(module, "__dict__", {}).values()):
+            if inspect.isclass(value) and value not in classes \
+                    and issubclass(value, cls) and name in value.__dict__:
+                classes.append(value)
+    return classes
+
+
+def get_handler_name(handler):
+    """Get a readable name of an event handler."""
+    name = getattr(handler, "__name__", None)
+    if name is None:
+        return repr(handler)
+    owner = getattr(handler, "__self__", None)
+    if owner is not None:
+        return "%s.%s" % (owner.__class__.__name__, name)
+    return name
+
+
+class Histogram(object):
+    """Durations in buckets of powers of two nanoseconds.
+
+    Bucket i counts durations below 2 ** i nanoseconds, which are not
+    counted by bucket i - 1."""
+    __slots__ = ['count', 'total', 'max', 'buckets']
+
+    BUCKETS = 48
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = min(int(seconds * 1e9).bit_length(), self.BUCKETS - 1)
+        self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        """Get the upper bound of the p-th percentile in seconds."""
+        rank = p * self.count
+        seen = 0
+        for (bucket, count) in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** bucket * 1e-9, self.max)
+        return 0.0
+
+    def snapshot(self):
+        """Get the statistics as dict.
+
+        The histogram is given as list of (upper bound in seconds,
+        count) tuples of the used buckets."""
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "histogram": [(2 ** bucket * 1e-9, count)
+                          for (bucket, count) in enumerate(self.buckets)
+                          if count],
+        }
+
+
+class Profiler(object):
+    """Collects timings of the stages of the matching engine.
+
+    The profiler is switched on and off at runtime:
+
+        profiler = Profiler()
+        with profiler:
+            engine.add_order(order)
+        profiler.snapshot(engine.orderbook)
+    """
+
+    # the enabled profiler, there is at most one
+    active = None
+
+    def __init__(self, events=None):
+        if events is None:
+            events = MatchingEngine.get_batched_events() \
+                + [MatchingEngine.onBatch]
+        self.events = events
+        self.stages = collections.OrderedDict(
+            (get_stage_name(cls, name), Histogram())
+            for (cls, name) in STAGES)
+        # event name -> Histogram of all handler calls
+        self.handlers = {}
+        # event name -> (seconds, handler) of the slowest handler call
+        self.slowest_handlers = {}
+        self.originals = []
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+        return False
+
+    def enable(self):
+        """Start measuring."""
+        assert Profiler.active is None
+        Profiler.active = self
+
+        for (cls, name) in STAGES:
+            histogram = self.stages[get_stage_name(cls, name)]
+            for override in get_overrides(cls, name):
+                function = override.__dict__[name]
+                self.originals.append((override, name, function))
+                setattr(override, name, self.wrap(histogram, function))
+
+        for event in self.events:
+            event.observe(self.observe_handler)
+
+    def disable(self):
+        """Stop measuring and restore the original methods."""
+        assert Profiler.active is self
+        Profiler.active = None
+
+        for (cls, name, function) in self.originals:
+            setattr(cls, name, function)
+        self.originals = []
+
+        for event in self.events:
+            event.stop_observing()
+
+    def reset(self):
+        """Discard all collected data."""
+        for histogram in self.stages.values():
+            histogram.reset()
+        self.handlers = {}
+        self.slowest_handlers = {}
+
+    @staticmethod
+    def wrap(histogram, function):
+        timer = timeit.default_timer
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.add(timer() - start)
+
+        return timed
+
+    def observe_handler(self, name, handler, seconds):
+        histogram = self.handlers.get(name)
+        if histogram is None:
+            histogram = self.handlers[name] = Histogram()
+        histogram.add(seconds)
+
+        slowest = self.slowest_handlers.get(name)
+        if slowest is None or seconds > slowest[0]:
+            self.slowest_handlers[name] = (seconds, handler)
+
+    def get_counters(self):
+        """Get counters derived from the number of stage calls.
+
+        Every lookup after the first one of an order is a re-entry of
+        the order into matching after a fill."""
+        def count(cls, name):
+            return self.stages[get_stage_name(cls, name)].count
+
+        orders = count(MatchingEngine, "add_order")
+        match_attempts = count(MatchingEngine, "get_best_match")
+        return {
+            "orders": orders,
+            "match_attempts": match_attempts,
+            "fills": count(MatchingEngine, "execute_orders"),
+            "reentries": max(0, match_attempts - orders),
+            "listings": count(Orderbook, "list"),
+            "delistings": count(Orderbook, "delist"),
+        }
+
+    def snapshot(self, orderbook=None):
+        """Get the collected data as dict.
+
+        If an orderbook is given, the number of open orders of each
+        currency pair is included as "book_sizes"."""
+        handlers = {}
+        for (name, histogram) in self.handlers.items():
+            handlers[name] = histogram.snapshot()
+            (seconds, handler) = self.slowest_handlers[name]
+            handlers[name]["slowest"] = get_handler_name(handler)
+            handlers[name]["slowest_seconds"] = seconds
+
+        result = {
+            "stages": collections.OrderedDict(
+                (stage, histogram.snapshot())
+                for (stage, histogram) in self.stages.items()),
+            "counters": self.get_counters(),
+            "handlers": handlers,
+        }
+
+        if orderbook is not None:
+            result["book_sizes"] = dict(
+                ("%s/%s" % pair, len(queue))
+                for (pair, queue) in orderbook.queues.items())
+
+        return result
+
+    def export(self, path, orderbook=None):
+        """Write a snapshot as JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.snapshot(orderbook), f, indent=2)
+
+
+def format_snapshot(snapshot):
+    """Format the stages and handlers of a snapshot as table."""
+    lines = ["%-40s %10s %10s %10s %10s %10s" % (
+        "stage", "calls", "total ms", "p50 us", "p99 us", "max us")]
+
+    rows = list(snapshot["stages"].items())
+    rows += sorted(("handlers of %s" % name, statistics)
+                   for (name, statistics) in snapshot["handlers"].items())
+
+    for (name, statistics) in rows:
+        if not statistics["count"]:
+            continue
+        lines.append("%-40s %10i %10.1f %10.1f %10.1f %10.1f" % (
+            name, statistics["count"], statistics["total"] * 1e3,
+            statistics["p50"] * 1e6, statistics["p99"] * 1e6,
+            statistics["max"] * 1e6))
+
+    for (name, statistics) in sorted(snapshot["handlers"].items()):
+        lines.append("slowest handler of %s: %s (%.1f us)" % (
+            name, statistics["slowest"],
+            statistics["slowest_seconds"] * 1e6))
+
+    lines.append(", ".join("%s: %i" % item
+                           for item in sorted(snapshot["counters"].items())))
+    return "\n".join(lines)
@@ -0,0 +1,162 @@
+from fractions import Fraction
+
+from simple_order_matching import OrderStatus
+
+# frozen reference of the matching rules. the engine is written to be
+# obviously correct instead of fast: the open orders are kept in a plain
+# list, which is scanned for every match, and all prices are exact
+# fractions. it is only used to check the optimized engine, see
+# differential.py, and must not be optimized or changed together with
+# it. a deliberate change of the matching rules has to be made here as
+# well.
+#
+# the rules:
+#
+#   - a new order is matched against the open orders of the inverse
+#     currency pair, starting with the lowest unit price. orders with
+#     the same unit price are executed by timestamp and then in the
+#     order they were listed.
+#   - an open order matches, if its unit price is at most the inverse
+#     of the new order's unit price.
+#   - the new order receives min(its amount desired, the amount for
+#     sale of the open order). the open order receives that amount
+#     times its unit price, rounded up.
+#   - after a trade the amount desired of both orders is reduced by the
+#     received amount and the amount for sale is recalculated with the
+#     previous unit price, rounded up. the order is filled, once the
+#     amount desired is zero.
+#   - a new order, whose expiry is reached already, is marked as
+#     expired without being executed or listed.
+#   - partially filled open orders keep their place in the listing
+#     order. the remaining new order is listed.
+#   - orders expire, once the block height reaches their expiry, in the
+#     order of expiry and listing.
+#
+# instead of firing events, the engine records a trace of (event name,
+# order, ...) tuples, in which orders are referred to by their labels.
+
+
+def ceil(fraction):
+    return -(-fraction.numerator // fraction.denominator)
+
+
+class ReferenceOrder(object):
+
+    def __init__(self, label, currency_for_sale, amount_for_sale,
+                 currency_desired, amount_desired, timestamp, expiry=None):
+        # the caller's name of the order, e.g. its position in a stream
+        self.label = label
+        self.currency_for_sale = currency_for_sale
+        self.amount_for_sale = amount_for_sale
+        self.currency_desired = currency_desired
+        self.amount_desired = amount_desired
+        self.timestamp = timestamp
+        self.expiry = expiry
+        self.status = OrderStatus.New
+        # position in the listing order, once listed
+        self.sequence = None
+
+    def get_unit_price(self):
+        return Fraction(self.amount_desired, self.amount_for_sale)
+
+
+class ReferenceEngine(object):
+
+    def __init__(self):
+        # open orders in the order they were listed
+        self.orders = []
+        self.sequence = 0
+        self.height = None
+        self.trace = []
+
+    def record(self, name, order, *args):
+        self.trace.append((name, order.label, order.status,
+                           order.amount_for_sale, order.amount_desired) + args)
+
+    def set_status(self, order, status):
+        if order.status != status:
+            self.record("onStatusUpdate", order, status)
+            order.status = status
+
+    def get_best_match(self, order_new):
+        candidates = [order for order in self.orders
+                      if order.currency_for_sale == order_new.currency_desired
+                      and order.currency_desired == order_new.currency_for_sale]
+        if not candidates:
+            return None
+
+        best = min(candidates, key=lambda order: (
+            order.get_unit_price(), order.timestamp, order.sequence))
+        if best.get_unit_price() > 1 / order_new.get_unit_price():
+            return None
+        return best
+
+    def add_order(self, order_new):
+        self.record("onOrderArrival", order_new)
+
+        if order_new.expiry is not None and self.height is not None \
+                and order_new.expiry <= self.height:
+            self.set_status(order_new, OrderStatus.Expired)
+            return
+
+        while order_new.status != OrderStatus.Filled:
+            order_old = self.get_best_match(order_new)
+            if order_old is None:
+                self.list(order_new)
+                break
+
+            amount_to_a2 = min(order_new.amount_desired,
+                               order_old.amount_for_sale)
+            amount_to_a1 = ceil(amount_to_a2 * order_old.get_unit_price())
+            self.record("onTrade", order_old, order_new.label,
+                        amount_to_a1, amount_to_a2)
+
+            self.update(order_old, amount_to_a1, amount_to_a2)
+            if order_old.status == OrderStatus.Filled:
+                self.delist(order_old)
+            self.update(order_new, amount_to_a2, amount_to_a1)
+
+    def update(self, order, amount_received, amount_spent):
+        amount_desired = order.amount_desired - amount_received
+        amount_for_sale = ceil(amount_desired / order.get_unit_price())
+        self.record("onPendingAmountUpdate", order,
+                    amount_for_sale, amount_desired)
+
+        order.amount_for_sale = amount_for_sale
+        order.amount_desired = amount_desired
+        if amount_desired > 0:
+            self.set_status(order, OrderStatus.PartiallyFilled)
+        else:
+            self.set_status(order, OrderStatus.Filled)
+        self.record("onUpdatedOrder", order, amount_received, amount_spent)
+
+    def list(self, order):
+        order.sequence = self.sequence
+        self.sequence += 1
+        self.orders.append(order)
+        self.record("onListing", order)
+
+    def delist(self, order):
+        self.orders.remove(order)
+        self.record("onDelisting", order)
+
+    def cancel_order(self, label):
+        for order in self.orders:
+            if order.label == label:
+                self.set_status(order, OrderStatus.Canceled)
+                self.delist(order)
+                return order
+        return None
+
+    def advance_to(self, height):
+        if self.height is None or self.height < height:
+            self.height = height
+
+        expired = sorted((order for order in self.orders
+                          if order.expiry is not None
+                          and order.expiry <= height),
+                         key=lambda order: (order.expiry, order.sequence))
+        for order in expired:
+            self.set_status(order, OrderStatus.Expired)
+            self.delist(order)
+        return expired
@@ -0,0 +1,388 @@
+import math
+
+import event
+from simple_order_matching import \
+    OrderStatus, Order, MatchingEngine, DEFAULT_STRATEGY
+
+# ring matching fills a new order not only against orders of the inverse
+# currency pair, but also along a path of open orders over other
+# currencies, e.g. an MSC -> BTC order against orders MSC -> Indiv1 and
+# Indiv1 -> BTC, if the path offers a better price.
+#
+# the liquidity graph has one edge for each currency pair with open
+# orders, from the currency desired to the currency for sale of the best
+# order of the pair. the weight of an edge is the logarithm of the unit
+# price, so the weight of a path is the logarithm of the price paid along
+# the path. the graph mirrors the orderbook, so only the edge of the
+# pair, which changed, is updated.
+#
+# paths of up to max_hops edges are found by a Bellman-Ford pass with
+# one round per hop, which keeps the cheapest path to each currency.
+# currencies are not visited twice on a path, so with more than three
+# hops a slightly more expensive path than the cheapest one may be
+# chosen. paths, which can't get cheaper than the direct match and the
+# price of the new order, are skipped early.
+#
+# the search uses floating point weights, but the amounts of a ring are
+# calculated exactly and the ring is only executed, if all orders
+# receive at least their price:
+#
+#   - the amounts are calculated backwards from the amount received by
+#     the new order, whereby each order of the path receives the amount
+#     it spends times its unit price, rounded up.
+#   - if an order can't spend the required amount, the amount received
+#     by the new order is reduced to what this order can pass on.
+#   - the new order pays at most its own unit price.
+#
+# each order of the ring receives its currency desired from the previous
+# order and passes its currency for sale on to the next one. the new
+# order starts and ends the ring.
+
+
+def get_weight(order):
+    """Get the weight of the edge of an order."""
+    return math.log(order.amount_desired) - math.log(order.amount_for_sale)
+
+
+class LiquidityGraph(object):
+    """Best unit prices of all currency pairs of an Orderbook.
+
+    The graph is kept up to date after orderbook.attach(graph)."""
+
+    def __init__(self, orderbook):
+        # currency desired -> currency for sale -> weight of the best
+        # order of the pair
+        self.edges = {}
+        # currency for sale -> currency desired -> weight, the same
+        # edges by target
+        self.incoming = {}
+        # currency desired -> lowest weight of its edges
+        self.lowest = {}
+        self.orderbook = orderbook
+        orderbook.attach(self)
+
+    def close(self):
+        """Stop mirroring the orderbook."""
+        self.orderbook.detach(self)
+
+    def update_pair(self, currency_for_sale, currency_desired):
+        best = self.orderbook.get_best_order(
+            currency_for_sale, currency_desired)
+        edges = self.edges.get(currency_desired)
+        previous = None
+        if edges is not None:
+            previous = edges.get(currency_for_sale)
+
+        if best is not None:
+            weight = get_weight(best)
+            if weight == previous:
+                return
+            if edges is None:
+                edges = self.edges[currency_desired] = {}
+            edges[currency_for_sale] = weight
+            self.incoming.setdefault(currency_for_sale, {})[currency_desired] \
+                = weight
+        elif previous is None:
+            return
+        else:
+            del edges[currency_for_sale]
+            del self.incoming[currency_for_sale][currency_desired]
+            if not self.incoming[currency_for_sale]:
+                del self.incoming[currency_for_sale]
+            if not edges:
+                del self.edges[currency_desired]
+                del self.lowest[currency_desired]
+                return
+
+        lowest = self.lowest.get(currency_desired)
+        if best is not None and (lowest is None or weight <= lowest):
+            self.lowest[currency_desired] = weight
+        elif previous == lowest:
+            self.lowest[currency_desired] = min(edges.values())
+
+    def add(self, order):
+        self.update_pair(order.currency_for_sale, order.currency_desired)
+
+    def update(self, order):
+        self.update_pair(order.currency_for_sale, order.currency_desired)
+
+    def remove(self, order):
+        self.update_pair(order.currency_for_sale, order.currency_desired)
+
+    def find_path(self, source, target, max_hops, bound=float("inf")):
+        """Find a cheap path of up to max_hops edges with a weight below
+        bound.
+
+        Returns a tuple of weight and list of currencies from source to
+        target or None, if there is no such path."""
+        incoming = self.incoming.get(target)
+        if incoming is None or source not in self.edges:
+            return None
+
+        # lower bounds of the weight of the rest of a path, which are 
+        # used to skip paths, which can't get below the bound
+        lowest_incoming = min(incoming.values())
+        lowest = min(0.0, min(self.lowest.values()))
+
+        # currency -> (weight, currency, previous entry) of the cheapest
+        # path with the number of hops of the round
+        paths = {source: (0.0, source, None)}
+        best = None
+
+        for hop in range(max_hops):
+            # complete the paths with an edge to the target
+            for (currency, entry) in paths.items():
+                weight = incoming.get(currency)
+                if weight is not None and entry[0] + weight < bound:
+                    bound = entry[0] + weight
+                    best = (bound, target, entry)
+
+            if hop + 1 == max_hops:
+                break
+
+            if hop + 2 == max_hops:
+                # only currencies with an edge to the target can be 
+                # visited before the last hop, so the paths are extended 
+                # and completed at once
+                for (currency, entry) in paths.items():
+                    edges = self.edges.get(currency)
+                    if edges is None or entry[0] + self.lowest[currency] \
+                            + lowest_incoming >= bound:
+                        continue
+                    for (other, weight, weight_incoming) in \
+                            self.join(edges, incoming):
+                        weight += entry[0]
+                        if weight + weight_incoming >= bound or \
+                                self.visits(entry, other):
+                            continue
+                        bound = weight + weight_incoming
+                        best = (bound, target, (weight, other, entry))
+                break
+
+            # extend the paths by one edge
+            rest = lowest_incoming + (max_hops - hop - 2) * lowest
+            next_paths = {}
+            for (currency, entry) in paths.items():
+                edges = self.edges.get(currency)
+                if edges is None or \
+                        entry[0] + self.lowest[currency] + rest >= bound:
+                    continue
+                for (other, weight) in edges.items():
+                    weight += entry[0]
+                    if other == target or weight + rest >= bound:
+                        continue
+                    known = next_paths.get(other)
+                    if known is not None and known[0] <= weight:
+                        continue
+                    if self.visits(entry, other):
+                        continue
+                    next_paths[other] = (weight, other, entry)
+
+            if not next_paths:
+                break
+            paths = next_paths
+
+        if best is None:
+            return None
+
+        currencies = []
+        entry = best
+        while entry is not None:
+            currencies.append(entry[1])
+            entry = entry[2]
+        currencies.reverse()
+        return (best[0], currencies)
+
+    @staticmethod
+    def join(edges, incoming):
+        """Get (currency, weight, weight to the target) tuples of the
+        currencies, which are reached by edges and lead to the target."""
+        if len(incoming) < len(edges):
+            return [(currency, edges[currency], weight)
+                    for (currency, weight) in incoming.items()
+                    if currency in edges]
+        return [(currency, weight, incoming[currency])
+                for (currency, weight) in edges.items()
+                if currency in incoming]
+
+    @staticmethod
+    def visits(entry, currency):
+        """Determine, if a path contains a currency."""
+        while entry is not None:
+            if entry[1] == currency:
+                return True
+            entry = entry[2]
+        return False
+
+
+def get_ring_amounts(order_new, orders):
+    """Calculate the amounts passed along a ring of orders.
+
+    Returns a list of amounts, whereby amounts[i] is received by
+    orders[i] and amounts[i + 1] is spent by it. The new order spends
+    amounts[0] and receives amounts[-1]. Returns None, if no whole units
+    can be exchanged within the limits of all orders."""
+    def get_amounts(amount_received):
+        amounts = [amount_received]
+        for order in reversed(orders):
+            amounts.append(-(-amounts[-1] * order.amount_desired
+                             // order.amount_for_sale))
+        amounts.reverse()
+        return amounts
+
+    amount_received = min(order_new.amount_desired,
+                          orders[-1].amount_for_sale)
+    amounts = get_amounts(amount_received)
+
+    # sellers[i] spends amounts[i]
+    sellers = [order_new] + orders
+    for (i, seller) in enumerate(sellers[:-1]):
+        if amounts[i] <= seller.amount_for_sale:
+            continue
+        # what the seller can pass on to the end of the ring
+        amount = seller.amount_for_sale
+        for order in orders[i:]:
+            amount = amount * order.amount_for_sale // order.amount_desired
+        amount_received = min(amount_received, amount)
+
+    if amount_received == 0:
+        return None
+    if amount_received != amounts[-1]:
+        amounts = get_amounts(amount_received)
+
+    # the new order pays at most its own unit price
+    if amounts[0] * order_new.amount_desired \
+            > amounts[-1] * order_new.amount_for_sale:
+        return None
+
+    return amounts
+
+
+class RingMatchingEngine(MatchingEngine):
+    """Matching engine, which also fills orders along paths of orders
+    over other currencies.
+
+    Paths of up to max_hops orders are considered. Direct matches are
+    executed as usual, while trades along longer paths are reported
+    with onRingTrade instead of onTrade."""
+    __slots__ = ['graph', 'max_hops']
+
+    onRingTrade = event.Event("onRingTrade")
+
+    def __init__(self, validate=True, max_hops=3, strategy=DEFAULT_STRATEGY):
+        MatchingEngine.__init__(self, validate, strategy)
+        self.max_hops = max_hops
+        self.graph = LiquidityGraph(self.orderbook)
+
+    def add_order(self, order_new):
+        """Add an order.
+
+        Returns Order after execution or listing.
+
+        In each step the order is executed against the ring with the
+        best price or the best direct match, until the order is filled
+        or the price is no longer acceptable."""
+        if self.validate:
+            assert None != order_new
+            self.report_order_arrival(order_new)
+        else:
+            self.onOrderArrival(order_new)
+
+        if self.orderbook.is_expired(order_new):
+            self.expire_order(order_new)
+            return order_new
+
+        while order_new.status != OrderStatus.Filled:
+            ring = self.get_best_ring(order_new)
+            if ring is not None:
+                self.execute_ring(order_new, *ring)
+                continue
+
+            best_match = self.get_best_match(order_new)
+            if best_match == None:
+                self.list_order(order_new)
+                break
+
+            self.execute_orders(best_match, order_new)
+
+        if order_new.status == OrderStatus.Filled:
+            self.retire(order_new)
+
+        return order_new
+
+    def get_best_ring(self, order_new):
+        """Find a ring, which is cheaper than the best direct match.
+
+        Returns a tuple of the listed orders and the amounts of the
+        ring, see get_ring_amounts, or None."""
+        # the ring must be cheaper than the direct match and the unit
+        # price of the order
+        bound = -get_weight(order_new)
+        edges = self.graph.edges.get(order_new.currency_for_sale)
+        if edges is not None:
+            bound = min(bound, edges.get(order_new.currency_desired, bound))
+
+        path = self.graph.find_path(
+            order_new.currency_for_sale, order_new.currency_desired,
+            self.max_hops, bound)
+        if path is None:
+            return None
+
+        currencies = path[1]
+        orders = [self.orderbook.get_best_order(currency_for_sale,
+                                                currency_desired)
+                  for (currency_desired, currency_for_sale)
+                  in zip(currencies, currencies[1:])]
+
+        amounts = get_ring_amounts(order_new, orders)
+        if amounts is None:
+            return None
+        return (orders, amounts)
+
+    def execute_ring(self, order_new, orders, amounts):
+        """Execute a ring and update the orders and the orderbook."""
+        validate = self.validate
+        if validate:
+            self.report_ring_trade(order_new, orders, amounts)
+        else:
+            self.onRingTrade(order_new, orders, amounts)
+
+        for (i, order) in enumerate(orders):
+            # each order of the ring is recorded as fill with the new
+            # order, whereby the currencies in between cancel out
+            if self.fills is not None:
+                self.fills.append(
+                    order.id, order_new.id, amounts[i], amounts[i + 1])
+
+            order.update_order(
+                amounts[i], amounts[i + 1], validate, self.strategy)
+            if order.status == OrderStatus.Filled:
+                self.orderbook.delist(order)
+                self.retire(order)
+            else:
+                self.orderbook.refresh(order)
+
+        order_new.update_order(
+            amounts[-1], amounts[0], validate, self.strategy)
+
+    @classmethod
+    def get_batched_events(cls):
+        return MatchingEngine.get_batched_events() + [cls.onRingTrade]
+
+    @classmethod
+    def report_ring_trade(cls, order_new, orders, amounts):
+        """Fires event after a trade along a ring with the new order,
+        the listed orders and the passed amounts."""
+        if not cls.onRingTrade:
+            return
+        assert isinstance(order_new, Order)
+        assert len(amounts) == len(orders) + 1
+        currency = order_new.currency_for_sale
+        for order in orders:
+            assert isinstance(order, Order)
+            assert order.currency_desired == currency
+            currency = order.currency_for_sale
+        assert currency == order_new.currency_desired
+        for amount in amounts:
+            assert isinstance(amount, long)
+        cls.onRingTrade(order_new, orders, amounts)
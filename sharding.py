@@ -0,0 +1,343 @@
+import multiprocessing
+import operator
+
+import event
+from simple_order_matching import \
+    OrderStatus, Order, MatchingEngine, get_market
+
+# orders of one currency pair are only matched against orders of the
+# inverse pair, so each market can be handled by an independent engine.
+# the markets are distributed over several worker processes, whereby
+# all orders of a market are processed by the same worker in the order
+# they were submitted.
+#
+# orders are passed to the workers as tuples of their attributes, see
+# pack_order, and the workers don't send orders back. the fired events
+# are sent as compact tuples of the event code, the ids of the orders
+# and the other arguments, together with the amounts, status and price
+# key of each involved order by id. the parent keeps the submitted
+# orders and only rebuilds copies in the state of the worker, if the
+# events are forwarded or there is an onBatch handler.
+
+ADD_ORDER = 0
+CANCEL_ORDER = 1
+ADVANCE = 2
+
+# the collected events by code and the number of their leading 
+# arguments, which are orders
+EVENTS = MatchingEngine.get_batched_events()
+ORDER_COUNTS = [2 if e is MatchingEngine.onTrade else 1 for e in EVENTS]
+NAMES = [e.name for e in EVENTS]
+# event name -> code
+EVENT_CODES = dict((name, code) for (code, name) in enumerate(NAMES))
+
+CLOSED_STATUSES = (
+    OrderStatus.Filled, OrderStatus.Canceled, OrderStatus.Expired)
+
+
+def encode_records(records, orders):
+    """Convert (name, args) event records into tuples of the event code, 
+    order ids and other arguments.
+
+    The orders of the events are collected in orders by id."""
+    encoded = []
+    for (name, args) in records:
+        code = EVENT_CODES[name]
+        count = ORDER_COUNTS[code]
+        ids = []
+        for order in args[:count]:
+            orders[order.id] = order
+            ids.append(order.id)
+        encoded.append((code, ) + tuple(ids) + args[count:])
+    return encoded
+
+
+def get_states(orders):
+    """Get the (amount for sale, amount desired, status, price key) 
+    states of orders by id."""
+    return dict((order_id, (order.amount_for_sale, order.amount_desired,
+                            order.status, order.price_key))
+                for (order_id, order) in orders.iteritems())
+
+
+# get the attributes of an Order as tuple, which is pickled faster than
+# the Order itself
+pack_order = operator.attrgetter(*Order.__slots__)
+
+
+def unpack_order(values):
+    """Restore an Order from pack_order without assigning a new id."""
+    order = Order.__new__(Order)
+    for (name, value) in zip(Order.__slots__, values):
+        setattr(order, name, value)
+    return order
+
+
+def get_view(order, state):
+    """Copy an Order with the state of a worker, see get_states."""
+    view = unpack_order(pack_order(order))
+    (view.amount_for_sale, view.amount_desired, view.status,
+     view.price_key) = state
+    return view
+
+
+def run_shard(connection, validate):
+    """Process orders of several markets in a worker process.
+
+    Each message is a tuple of a command and a list of (market, packed
+    order or order id) tuples. A list with the id of the resulting order or 
+    None and the encoded events of each item is sent back, together 
+    with the states of the involved orders, see encode_records. ADVANCE 
+    messages carry a block height instead, whereupon the ids of the 
+    expired orders and the encoded events of each engine are sent 
+    back."""
+    engines = {}
+    height = None
+
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+
+        (command, items) = message
+        results = []
+        # order id -> Order of the orders involved in the message
+        orders = {}
+
+        if command == ADVANCE:
+            height = items
+            for market in list(engines):
+                engine = engines[market]
+                with event.EventBatch(EVENTS) as batch:
+                    expired = engine.advance_to(height)
+                if not engine.orderbook.orders:
+                    del engines[market]
+                for order in expired:
+                    orders[order.id] = order
+                results.append(([order.id for order in expired],
+                                encode_records(batch.records, orders)))
+
+            connection.send((results, get_states(orders)))
+            continue
+
+        # handlers inherited from the parent process are not called
+        with event.EventBatch(EVENTS) as batch:
+            for (market, item) in items:
+                engine = engines.get(market)
+                if engine is None:
+                    engine = engines[market] = MatchingEngine(validate)
+                    if height is not None:
+                        engine.advance_to(height)
+
+                del batch.records[:]
+                if command == ADD_ORDER:
+                    order = engine.add_order(unpack_order(item))
+                else:
+                    order = engine.cancel_order(item)
+
+                # engines of markets without open orders are dropped
+                if not engine.orderbook.orders:
+                    del engines[market]
+
+                order_id = None
+                if order is not None:
+                    orders[order.id] = order
+                    order_id = order.id
+                results.append(
+                    (order_id, encode_records(batch.records, orders)))
+
+        connection.send((results, get_states(orders)))
+
+    connection.close()
+
+
+class ShardedMatchingEngine(object):
+    """Matching engine, which handles markets in parallel processes.
+
+    The events of all workers are merged in the order the orders were
+    submitted and delivered with the onBatch event, as it is done by
+    MatchingEngine.add_orders. The orders in the events are copies,
+    which reflect the state within the worker at the end of the 
+    batch."""
+    __slots__ = ['processes', 'connections', 'shards', 'open_orders']
+
+    onBatch = event.Event("onBatch")
+
+    def __init__(self, processes=None, validate=True):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        assert 0 < processes
+
+        self.processes = []
+        self.connections = []
+        for _ in range(processes):
+            (connection, worker_connection) = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_shard, args=(worker_connection, validate))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.connections.append(connection)
+
+        # market -> index of the worker, which handles the market
+        self.shards = {}
+        # order id -> submitted Order of the open orders
+        self.open_orders = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """Stop all worker processes."""
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def get_shard(self, market):
+        """Get the index of the worker, which handles the market.
+
+        New markets are assigned to the workers in turn."""
+        shard = self.shards.get(market)
+        if shard is None:
+            shard = self.shards[market] = \
+                len(self.shards) % len(self.connections)
+        return shard
+
+    def add_order(self, order, forward=False):
+        """Add an order.
+
+        Returns a copy of the Order after execution or listing."""
+        return self.add_orders([order], forward)[0]
+
+    def add_orders(self, orders, forward=False):
+        """Add several orders.
+
+        Returns the list of copied Orders after execution or listing.
+        If forward is set, the handlers of the single events are called
+        in addition to onBatch."""
+        items = []
+        for order in orders:
+            self.open_orders[order.id] = order
+            items.append((get_market(order), pack_order(order)))
+
+        return self.dispatch(ADD_ORDER, items, forward)
+
+    def cancel_order(self, order_id, forward=False):
+        """Cancel an open order.
+
+        Returns a copy of the canceled Order or None, if there is no
+        open order with the given id."""
+        order = self.open_orders.get(order_id)
+        if order is None:
+            return None
+
+        return self.dispatch(
+            CANCEL_ORDER, [(get_market(order), order_id)], forward)[0]
+
+    def advance_to(self, height, forward=False):
+        """Expire all open orders with an expiry up to the block height.
+
+        Returns the list of copies of the expired Orders."""
+        for connection in self.connections:
+            connection.send((ADVANCE, height))
+
+        expired = []
+        records = []
+        states = {}
+        for connection in self.connections:
+            (results, shard_states) = connection.recv()
+            states.update(shard_states)
+            for (engine_expired, engine_records) in results:
+                expired.extend(engine_expired)
+                records.extend(engine_records)
+
+        return self.deliver(expired, records, states, forward)
+
+    def dispatch(self, command, items, forward):
+        """Process (market, order or order id) tuples in the workers.
+
+        The items of all workers are processed in parallel and the
+        results are merged in the order of the items."""
+        # positions of the items handled by each worker
+        positions = [[] for _ in self.connections]
+        for (position, (market, item)) in enumerate(items):
+            positions[self.get_shard(market)].append(position)
+
+        for (shard, shard_positions) in enumerate(positions):
+            if shard_positions:
+                self.connections[shard].send(
+                    (command, [items[i] for i in shard_positions]))
+
+        results = [None] * len(items)
+        states = {}
+        for (shard, shard_positions) in enumerate(positions):
+            if shard_positions:
+                (shard_results, shard_states) = self.connections[shard].recv()
+                states.update(shard_states)
+                for (position, result) in zip(shard_positions, shard_results):
+                    results[position] = result
+
+        records = []
+        for (order_id, order_records) in results:
+            records.extend(order_records)
+
+        return self.deliver([order_id for (order_id, _) in results],
+                            records, states, forward)
+
+    def deliver(self, order_ids, records, states, forward):
+        """Fire the events collected by the workers.
+
+        Returns copies of the orders of order_ids, whereby None is 
+        kept."""
+        # order id -> copy in the state of the worker
+        views = {}
+
+        def get(order_id):
+            view = views.get(order_id)
+            if view is None:
+                view = views[order_id] = get_view(
+                    self.open_orders[order_id], states[order_id])
+            return view
+
+        orders = [None if order_id is None else get(order_id)
+                  for order_id in order_ids]
+
+        decoded = None
+        if forward or self.onBatch:
+            decoded = []
+            for record in records:
+                code = record[0]
+                if ORDER_COUNTS[code] == 1:
+                    args = (get(record[1]), ) + record[2:]
+                else:
+                    args = (get(record[1]), get(record[2])) + record[3:]
+                decoded.append((NAMES[code], args))
+
+        # closed orders are no longer routed
+        for (order_id, state) in states.iteritems():
+            if state[2] in CLOSED_STATUSES:
+                self.open_orders.pop(order_id, None)
+
+        if forward:
+            for (name, args) in decoded:
+                EVENTS[EVENT_CODES[name]](*args)
+
+        if decoded is not None:
+            self.report_batch(decoded)
+        return orders
+
+    @classmethod
+    def report_batch(cls, records):
+        """Fires event with all events collected during a batch."""
+        if not cls.onBatch:
+            return
+        assert isinstance(records, list)
+        cls.onBatch(records)
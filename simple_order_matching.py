@@ -1,5 +1,8 @@
 import time
 import math
+import heapq
+import collections
+from fractions import Fraction
 
 import event
 
@@ -13,75 +16,502 @@ class OrderStatus:
     PartiallyFilled = 1
     Filled = 2
     Canceled = 3
+    Expired = 4
 
     AsString = {
         New: "new",
         PartiallyFilled: "partially filled",
         Filled: "filled completely",
         Canceled: "canceled",
+        Expired: "expired",
     }
 
+
+class Currency(object):
+    """Interned currencies.
+
+    Currencies can be any hashable values, but orders with small 
+    integer ids are compared and indexed faster than orders with 
+    strings. The ids are assigned in the order the currencies are 
+    interned."""
+
+    __ids = {}
+    __names = []
+
+    @classmethod
+    def intern(cls, name):
+        """Get the id of a currency, which is assigned once."""
+        currency_id = cls.__ids.get(name)
+        if currency_id is None:
+            currency_id = cls.__ids[name] = len(cls.__names)
+            cls.__names.append(name)
+        return currency_id
+
+    @classmethod
+    def get_name(cls, currency_id):
+        """Get the currency of an id."""
+        return cls.__names[currency_id]
+
+
+# unit prices are compared as fixed-point numbers with this number of 
+# fractional bits. as long as amounts are below 2**64, different unit 
+# prices never share the same key, so the comparison is exact
+PRICE_KEY_BITS = 128
+
+
+def get_price_key(amount_desired, amount_for_sale):
+    """Get the fixed-point sort key of the unit price."""
+    return (amount_desired << PRICE_KEY_BITS) // amount_for_sale
+
+
+def get_market(order):
+    """Get the market of an order.
+
+    A market covers both (currency_for_sale, currency_desired) pairs, 
+    which are matched against each other."""
+    return tuple(sorted((order.currency_for_sale, order.currency_desired)))
+
     
-class Orderbook(object):
-    __slots__ = ['orders']
+class MatchingStrategy(object):
+    """Rules of the matching engine, which may be varied.
+
+    The default strategy prioritizes older orders among orders with 
+    the same price, rounds the amount to the listed order up and rounds 
+    the remaining amount for sale of partially filled orders up. Other 
+    strategies override single methods."""
+
+    name = "price-time"
+
+    def get_priority(self, order):
+        """Get the sort key of an order among orders with the same unit 
+        price, whereby lower keys are executed first."""
+        return order.timestamp
 
-    onListing = event.Event()
-    onDelisting = event.Event()
+    def calculate_traded_amounts(self, order_old, order_new):
+        """Calculate traded amounts without any checks.
 
-    def __init__(self):
-        self.orders = []
+        The orders are assumed to match with each other. Returns the 
+        amount to the listed order and the amount to the new order."""
+        # extra variables are used for better readability
+        a1_available = order_old.amount_for_sale
+        a1_desired = order_old.amount_desired
+        a2_desired = order_new.amount_desired
+        
+        # these are the traded amounts, whereby the amount to the 
+        # existing order is rounded up to whole units
+        amount_to_a2 = min(a2_desired, a1_available)
+        amount_to_a1 = -(-amount_to_a2 * a1_desired // a1_available)
+
+        return (amount_to_a1, amount_to_a2)
+
+    def calculate_remaining_amount_for_sale(self, order, amount_desired):
+        """Get the amount for sale of a partially filled order, based on 
+        the remaining amount desired and the current amounts."""
+        # rounding up was chosen, because the user still receives the 
+        # amount he wanted in the first place in total and in the case 
+        # of rounding down the price may be "below market price"
+        return -(-amount_desired * order.amount_for_sale
+                 // order.amount_desired)
+
+
+DEFAULT_STRATEGY = MatchingStrategy()
+
+
+class OrderQueue(object):
+    """Open orders of one currency pair in price-time priority.
+
+    The orders are kept in a heap, so the best order is available in 
+    constant time and listing is done in logarithmic time. Removed 
+    orders are only marked as such and dropped, once they reach the 
+    top of the heap or once they make up most of the heap.
+
+    The total amount for sale and number of orders is further tracked 
+    for each price level. The price keys of the levels are kept in a 
+    second heap, from which the keys of removed levels are dropped the 
+    same way."""
+    __slots__ = ['heap', 'entries', 'levels', 'prices', 'heaped_prices',
+                 'strategy']
+
+    # entries are lists of unit price, priority given by the strategy, 
+    # sequence number, order and amount for sale at the time of listing
+    ORDER = 3
+    SEQUENCE = 2
+
+    def __init__(self, strategy=DEFAULT_STRATEGY):
+        self.strategy = strategy
+        self.heap = []
+        self.entries = {}
+        # price key -> [total amount for sale, number of orders, unit 
+        # price]
+        self.levels = {}
+        # heap of the price keys of all levels and possibly of removed 
+        # levels, whereby each key is contained at most once
+        self.prices = []
+        self.heaped_prices = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        """Iterate over the orders, sorted by price and priority."""
+        for entry in sorted(self.entries.values()):
+            yield entry[self.ORDER]
+
+    def push(self, order, sequence):
+        """Add an order.
+
+        The sequence number is used to break ties between orders with 
+        the same price and priority, so that orders listed earlier 
+        are prioritized."""
+        # entries are compared element by element and the sequence 
+        # number is unique, so orders are never compared directly
+        entry = [order.price_key, self.strategy.get_priority(order),
+                 sequence, order, order.amount_for_sale]
+        self.entries[order.id] = entry
+        heapq.heappush(self.heap, entry)
+
+        level = self.levels.get(order.price_key)
+        if level is None:
+            self.levels[order.price_key] = [
+                order.amount_for_sale, 1,
+                Fraction(order.amount_desired, order.amount_for_sale)]
+            if order.price_key not in self.heaped_prices:
+                self.heaped_prices.add(order.price_key)
+                heapq.heappush(self.prices, order.price_key)
+        else:
+            level[0] += order.amount_for_sale
+            level[1] += 1
+
+    def remove(self, order):
+        """Remove an order and return its sequence number."""
+        entry = self.entries.pop(order.id)
+        entry[self.ORDER] = None
+
+        # the price and amount of the entry are used, because the 
+        # order may have been updated in the meantime
+        price_key = entry[0]
+        level = self.levels[price_key]
+        level[0] -= entry[-1]
+        level[1] -= 1
+        if level[1] == 0:
+            del self.levels[price_key]
+            # rebuild the heap of price keys, if it consists mostly of 
+            # removed levels
+            if len(self.prices) > 2 * len(self.levels) + 32:
+                self.prices = list(self.levels)
+                heapq.heapify(self.prices)
+                self.heaped_prices = set(self.prices)
+
+        # rebuild the heap, if it consists mostly of removed entries
+        if len(self.heap) > 2 * len(self.entries) + 32:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+        return entry[self.SEQUENCE]
+
+    def refresh(self, order):
+        """Re-sort an order after its amounts were updated."""
+        sequence = self.remove(order)
+        self.push(order, sequence)
+
+    def peek(self):
+        """Get the order with the best price or None."""
+        heap = self.heap
+        while heap and heap[0][self.ORDER] is None:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][self.ORDER]
+        return None
+
+    def iter_best(self):
+        """Iterate over the orders, starting with the best price.
+
+        Only the visited part of the heap is sorted, so the first k 
+        orders are retrieved in O(k log k). The queue must not be 
+        changed during the iteration."""
+        heap = self.heap
+        candidates = []
+        if heap:
+            candidates.append((heap[0], 0))
+        while candidates:
+            (entry, index) = heapq.heappop(candidates)
+            if entry[self.ORDER] is not None:
+                yield entry[self.ORDER]
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(heap):
+                    heapq.heappush(candidates, (heap[child], child))
+
+    def get_best_price(self):
+        """Get the price key of the best level or None."""
+        prices = self.prices
+        while prices and prices[0] not in self.levels:
+            self.heaped_prices.discard(heapq.heappop(prices))
+        if prices:
+            return prices[0]
+        return None
+
+    def depth(self, levels):
+        """Get up to levels tuples of unit price, total amount for sale 
+        and number of orders, starting with the best price.
+
+        As with iter_best, only the visited part of the heap of price 
+        keys is sorted."""
+        prices = self.prices
+        result = []
+        candidates = []
+        if prices and levels > 0:
+            candidates.append((prices[0], 0))
+        while candidates and len(result) < levels:
+            (price_key, index) = heapq.heappop(candidates)
+            if price_key in self.levels:
+                result.append(self.get_level(price_key))
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(prices):
+                    heapq.heappush(candidates, (prices[child], child))
+        return result
+
+    def get_level(self, price_key):
+        """Get unit price, total amount for sale and number of orders."""
+        (amount_for_sale, count, unit_price) = self.levels[price_key]
+        return (unit_price, amount_for_sale, count)
+
+
+class Orderbook(object):
+    __slots__ = ['orders', 'queues', 'markets', 'sequence', 'validate',
+                 'mirrors', 'expiries', 'expiring', 'height', 'strategy']
+
+    onListing = event.Event("onListing")
+    onDelisting = event.Event("onDelisting")
+
+    def __init__(self, validate=True, strategy=DEFAULT_STRATEGY):
+        # sanity checks are skipped, if validation is disabled
+        self.validate = validate
+        # the strategy determines the priority of orders with the same 
+        # price
+        self.strategy = strategy
+        # open orders by id, in the order they were listed
+        self.orders = collections.OrderedDict()
+        # one queue for each (currency_for_sale, currency_desired) pair
+        self.queues = {}
+        # number of open orders for each currency pair, whereby a pair 
+        # and its inverse are counted together
+        self.markets = collections.OrderedDict()
+        self.sequence = 0
+        # other representations of the open orders, which are kept up 
+        # to date via add, remove and update methods
+        self.mirrors = []
+        # heap of (expiry, sequence, order) tuples of listed orders with 
+        # an expiry, whereby delisted orders are dropped lazily
+        self.expiries = []
+        # number of listed orders with an expiry
+        self.expiring = 0
+        # the block height, up to which orders were expired
+        self.height = None
 
     def list(self, order):
         """Add an order to the orderbook."""
-        assert isinstance(order, Order)
-        self.orders.append(order)
-        self.report_listing(order)
+        if self.validate:
+            assert isinstance(order, Order)
+            assert order.id not in self.orders
+        self.orders[order.id] = order
+
+        pair = (order.currency_for_sale, order.currency_desired)
+        queue = self.queues.get(pair)
+        if queue is None:
+            queue = self.queues[pair] = OrderQueue(self.strategy)
+        queue.push(order, self.sequence)
+        if order.expiry is not None:
+            heapq.heappush(self.expiries, (order.expiry, self.sequence, order))
+            self.expiring += 1
+        self.sequence += 1
+
+        market = self.get_market(order)
+        if market is None:
+            self.markets[(order.currency_desired, order.currency_for_sale)] = 1
+        else:
+            self.markets[market] += 1
+
+        for mirror in self.mirrors:
+            mirror.add(order)
+
+        if self.validate:
+            self.report_listing(order)
+        else:
+            self.onListing(order)
 
     def delist(self, order):
         """Remove an order from the orderbook."""
-        assert isinstance(order, Order)
-        self.orders.remove(order)
-        self.report_delisting(order)
+        if self.validate:
+            assert isinstance(order, Order)
+        del self.orders[order.id]
+
+        pair = (order.currency_for_sale, order.currency_desired)
+        queue = self.queues[pair]
+        queue.remove(order)
+        if not queue:
+            del self.queues[pair]
+
+        market = self.get_market(order)
+        self.markets[market] -= 1
+        if self.markets[market] == 0:
+            del self.markets[market]
+
+        if order.expiry is not None:
+            self.expiring -= 1
+            # drop the entries of delisted orders, if they make up most 
+            # of the heap
+            if len(self.expiries) > 2 * self.expiring + 32:
+                self.expiries = [entry for entry in self.expiries
+                                 if entry[2].id in self.orders]
+                heapq.heapify(self.expiries)
+
+        for mirror in self.mirrors:
+            mirror.remove(order)
+
+        if self.validate:
+            self.report_delisting(order)
+        else:
+            self.onDelisting(order)
+
+    def cancel(self, order_id):
+        """Cancel an open order and remove it from the orderbook.
+
+        Returns the canceled Order or None, if there is no open order 
+        with the given id."""
+        order = self.orders.get(order_id)
+        if order is None:
+            return None
+
+        order.set_status(OrderStatus.Canceled, self.validate)
+        self.delist(order)
+        return order
+
+    def expire(self, height):
+        """Expire and remove all orders with an expiry up to height.
+
+        Returns the list of expired Orders, ordered by expiry."""
+        if self.height is None or self.height < height:
+            self.height = height
+
+        expired = []
+        expiries = self.expiries
+        while expiries and expiries[0][0] <= height:
+            order = heapq.heappop(expiries)[2]
+            # the order may have been filled or canceled already
+            if self.orders.get(order.id) is not order:
+                continue
+            order.set_status(OrderStatus.Expired, self.validate)
+            self.delist(order)
+            expired.append(order)
+        return expired
+
+    def is_expired(self, order):
+        """Determine, if the expiry of an order has been reached."""
+        return order.expiry is not None and self.height is not None \
+            and order.expiry <= self.height
+
+    def attach(self, mirror):
+        """Keep another representation of the open orders up to date.
+
+        The mirror is filled with the open orders and then informed 
+        about changes with add(order), remove(order) and update(order) 
+        calls."""
+        for order in self.orders.values():
+            mirror.add(order)
+        self.mirrors.append(mirror)
+
+    def detach(self, mirror):
+        self.mirrors.remove(mirror)
+
+    def get_order(self, order_id):
+        """Get an open order by id or None."""
+        return self.orders.get(order_id)
+
+    def refresh(self, order):
+        """Re-sort a listed order after its amounts were updated."""
+        self.queues[(order.currency_for_sale, order.currency_desired)] \
+            .refresh(order)
+
+        for mirror in self.mirrors:
+            mirror.update(order)
 
     def get_orders(self, currency_for_sale, currency_desired):
         """Get orders with the desired currency pair.
 
-        Orders are sorted by price whereby old orders are prioritized."""        
-        potential_orders = \
-            list(filter(lambda order:
-            order.currency_for_sale == currency_for_sale and 
-            order.currency_desired == currency_desired, self.orders))
-
-        # sort orders by price and timestamp
-        # timestamp represents block height and transaction position
-        potential_orders.sort(key=lambda order: order.timestamp)
-        potential_orders.sort(key=lambda order: order.get_unit_price())
-        return potential_orders
+        Orders are sorted by price whereby old orders are prioritized."""
+        queue = self.queues.get((currency_for_sale, currency_desired))
+        if queue is None:
+            return []
+        return list(queue)
+
+    def get_best_order(self, currency_for_sale, currency_desired):
+        """Get the order with the best price for the currency pair.
+
+        In the case of more than one candidate, the oldest one is 
+        chosen. Returns None, if there is no open order."""
+        queue = self.queues.get((currency_for_sale, currency_desired))
+        if queue is None:
+            return None
+        return queue.peek()
     
-    def get_currrencies(self):
-        """Retrieve all currency pairs with at least one open order."""
-        currencies = []
+    def depth(self, pair, levels=10):
+        """Get aggregated orders of a (currency_for_sale, 
+        currency_desired) pair.
+
+        Returns a list with up to levels tuples of unit price, total 
+        amount for sale and number of orders, starting with the best 
+        price."""
+        queue = self.queues.get(pair)
+        if queue is None:
+            return []
+        return queue.depth(levels)
+
+    def get_top_of_book(self, pair):
+        """Get the best price level of a (currency_for_sale, 
+        currency_desired) pair.
+
+        Returns a tuple of unit price, total amount for sale and number 
+        of orders or None, if there is no open order."""
+        queue = self.queues.get(pair)
+        if queue is None:
+            return None
+        price_key = queue.get_best_price()
+        if price_key is None:
+            return None
+        return queue.get_level(price_key)
 
-        for order in self.orders:
-            pair = (order.currency_desired, order.currency_for_sale)
+    def get_currrencies(self):
+        """Retrieve all currency pairs with at least one open order.
 
-            if pair not in currencies:
-                pair_inverse = (order.currency_for_sale, order.currency_desired)
-                if pair_inverse not in currencies:
-                    currencies.append(pair)
+        A pair and its inverse are only included once, in the 
+        orientation (currency_desired, currency_for_sale) of the order 
+        which opened the market."""
+        return list(self.markets)
 
-        return currencies
+    def get_market(self, order):
+        """Get the registered currency pair of an order or None."""
+        pair = (order.currency_desired, order.currency_for_sale)
+        if pair in self.markets:
+            return pair
+        pair_inverse = (order.currency_for_sale, order.currency_desired)
+        if pair_inverse in self.markets:
+            return pair_inverse
+        return None
 
 
     @classmethod
     def report_listing(cls, order):
         """Fires an event for a new listings."""
+        if not cls.onListing:
+            return
         assert isinstance(order, Order)
         cls.onListing(order)
 
     @classmethod
     def report_delisting(cls, order):
         """Fires an event for a delisted entry."""
+        if not cls.onDelisting:
+            return
         assert isinstance(order, Order)
         cls.onDelisting(order)
 
@@ -90,18 +520,19 @@ class Order(object):
     __slots__ = [
         'id', 'timestamp', 'status',
         'currency_for_sale', 'amount_for_sale', 'initial_amount_for_sale',
-        'currency_desired', 'amount_desired', 'initial_amount_desired']
+        'currency_desired', 'amount_desired', 'initial_amount_desired',
+        'price_key', 'expiry']
 
     __id = -1
 
-    onNewOrder = event.Event()
-    onPendingAmountUpdate = event.Event()
-    onUpdatedOrder = event.Event()
-    onStatusUpdate = event.Event()
+    onNewOrder = event.Event("onNewOrder")
+    onPendingAmountUpdate = event.Event("onPendingAmountUpdate")
+    onUpdatedOrder = event.Event("onUpdatedOrder")
+    onStatusUpdate = event.Event("onStatusUpdate")
 
     def __init__(self, currency_for_sale, amount_for_sale, 
                  currency_desired, amount_desired, timestamp=None,
-                 status=0):
+                 status=0, expiry=None):
 
         assert 0 < long(math.floor(amount_for_sale))
         assert 0 < long(math.floor(amount_desired))        
@@ -116,6 +547,8 @@ class Order(object):
 
         self.timestamp = timestamp
         self.status = status
+        # the block height, at which the order expires, or None
+        self.expiry = expiry
         self.currency_for_sale = currency_for_sale
         self.currency_desired = currency_desired
 
@@ -130,12 +563,17 @@ class Order(object):
         # store to calculate total amounts later
         self.initial_amount_desired = self.amount_desired
         self.initial_amount_for_sale = self.amount_for_sale        
+
+        # the exact unit price is used for sorting, so no floating point 
+        # divisions are done during order execution
+        self.price_key = get_price_key(
+            self.amount_desired, self.amount_for_sale)
                 
         # report creation of new order
         self.report_new_order(self)
         
     def get_unit_price(self):
-        """Upper price limit"""
+        """Upper price limit as floating point number for display"""
         unit_price = float('Inf')
         if self.amount_for_sale > 0:
             unit_price = \
@@ -155,11 +593,24 @@ class Order(object):
         return received
     
     def would_accept(self, unit_price_proposed):
-        """Accept (inverse) unit prices which are considered as better."""
-        unit_price = self.get_unit_price()
-        order_accepted = unit_price <= unit_price_proposed
+        """Accept (inverse) unit prices which are considered as better.
+
+        The unit price is compared exactly, e.g. given as Fraction."""
+        unit_price_proposed = Fraction(unit_price_proposed)
+        order_accepted = \
+            self.amount_desired * unit_price_proposed.denominator \
+            <= unit_price_proposed.numerator * self.amount_for_sale
         return order_accepted
     
+    def accepts_price_of(self, order_new):
+        """Determine, if the reciprocal of another order's unit price 
+        is accepted.
+
+        The prices are compared by cross-multiplication to avoid the 
+        division."""
+        return self.amount_desired * order_new.amount_desired \
+            <= self.amount_for_sale * order_new.amount_for_sale
+
     def matches_with(self, order_new):
         """Determine, if this order can be matched against another one."""
         assert isinstance(order_new, Order)
@@ -180,17 +631,17 @@ class Order(object):
         
         # existing order's unit price is less than or equal to the 
         # reciprocal of the new order's unit price
-        reciprocal = order_new.get_unit_price_inverse()
-        accepted_price = self.would_accept(reciprocal)
+        accepted_price = self.accepts_price_of(order_new)
 
         # existing order's address is not the new order's address
         no_self_trade = True
 
-        # existing order is still open (not completely fulfilled or 
-        # canceled)
+        # existing order is still open (not completely fulfilled, 
+        # canceled or expired)
         open_order = \
             self.status != OrderStatus.Canceled \
-            and self.status != OrderStatus.Filled
+            and self.status != OrderStatus.Filled \
+            and self.status != OrderStatus.Expired
 
         # only match, if all requirements are fulfilled
         valid_match = \
@@ -202,57 +653,71 @@ class Order(object):
 
         return valid_match
 
-    def update_order(self, amount_received, amount_spent):
+    def update_order(self, amount_received, amount_spent, validate=True,
+                     strategy=DEFAULT_STRATEGY):
         """Fill and update order.
         
         The order is updated based on received and spent amounts. The 
         order is considered as completely filled, if the full "desired" 
-        amount is reached."""
-        assert 0 < long(math.floor(amount_received))
-        assert 0 < long(math.floor(amount_spent))
+        amount is reached. Sanity checks are skipped, if validate is 
+        not set. The remaining amount for sale is determined by the 
+        strategy."""
+        if validate:
+            assert 0 < long(math.floor(amount_received))
+            assert 0 < long(math.floor(amount_spent))
         
         # desired amount is based on limit price
         updated_amount_desired = self.amount_desired - amount_received
 
         # the new amount for sale is derived from desired amount (!)
-        updated_amount_for_sale = \
-            float(updated_amount_desired) / self.get_unit_price()
+        updated_amount_for_sale = strategy.calculate_remaining_amount_for_sale(
+            self, updated_amount_desired)
 
-        # rounding up was chosen, because the user still receives the 
-        # amount he wanted in the first place in total and in the case 
-        # of rounding down the price may be "below market price"
-        updated_amount_for_sale = long(math.ceil(updated_amount_for_sale))
-        assert updated_amount_for_sale == updated_amount_for_sale
+        if validate:
+            # make sure not more than remaining units are sold
+            updated_amount_remaining = self.amount_for_sale - amount_spent
+            assert updated_amount_for_sale <= updated_amount_remaining
 
-        # make sure not more than remaining units are sold
-        updated_amount_remaining = self.amount_for_sale - amount_spent
-        assert updated_amount_for_sale <= updated_amount_remaining
-        
-        # report updated amounts before applying them
-        self.report_pending_update(
-            self, updated_amount_for_sale, updated_amount_desired)
+            # report updated amounts before applying them
+            self.report_pending_update(
+                self, updated_amount_for_sale, updated_amount_desired)
+        else:
+            self.onPendingAmountUpdate(
+                self, updated_amount_for_sale, updated_amount_desired)
 
         # set updated amounts
         self.amount_desired = updated_amount_desired
         self.amount_for_sale = updated_amount_for_sale
 
+        # the price may change slightly due to rounding, but it is kept 
+        # for orders which are filled completely
+        if updated_amount_desired > 0:
+            self.price_key = get_price_key(
+                updated_amount_desired, updated_amount_for_sale)
+
         # the order is filled completely, if the desired amount is 
         # reached
         if updated_amount_desired > 0:
-            self.set_status(OrderStatus.PartiallyFilled)
+            self.set_status(OrderStatus.PartiallyFilled, validate)
         else:
-            self.set_status(OrderStatus.Filled)
+            self.set_status(OrderStatus.Filled, validate)
         
         # report traded amounts
-        self.report_updated_order(self, amount_received, amount_spent)
+        if validate:
+            self.report_updated_order(self, amount_received, amount_spent)
+        else:
+            self.onUpdatedOrder(self, amount_received, amount_spent)
 
         return self
        
-    def set_status(self, new_status):
+    def set_status(self, new_status, validate=True):
         """Updates status of the Order."""
         if self.status != new_status:
             # report new status
-            self.report_status_update(self, new_status)
+            if validate:
+                self.report_status_update(self, new_status)
+            else:
+                self.onStatusUpdate(self, new_status)
             self.status = new_status
 
     def id_to_string(self):
@@ -264,12 +729,102 @@ class Order(object):
              self.amount_desired, self.currency_desired,
              self.get_unit_price(), self.get_unit_price_inverse())
         return s
+
+    def __copy__(self):
+        """Copy the order without assigning a new id or reporting it."""
+        order = Order.__new__(Order)
+        for name in Order.__slots__:
+            setattr(order, name, getattr(self, name))
+        return order
  
     @classmethod
     def __get_new_id(cls):
         cls.__id = cls.__id + 1
         return cls.__id
 
+    @classmethod
+    def get_last_id(cls):
+        """Get the id of the last created order."""
+        return cls.__id
+
+    @classmethod
+    def reserve_id(cls, order_id):
+        """Make sure new orders get higher ids than the given one."""
+        if cls.__id < order_id:
+            cls.__id = order_id
+
+    @classmethod
+    def restore(cls, order_id, timestamp, status,
+                currency_for_sale, amount_for_sale, initial_amount_for_sale,
+                currency_desired, amount_desired, initial_amount_desired,
+                expiry=None):
+        """Recreate an open order with the given id and state.
+
+        This is used to load persisted orders, so no event is fired."""
+        order = cls.__new__(cls)
+        order.id = order_id
+        order.timestamp = timestamp
+        order.status = status
+        order.expiry = expiry
+        order.currency_for_sale = currency_for_sale
+        order.amount_for_sale = long(amount_for_sale)
+        order.initial_amount_for_sale = long(initial_amount_for_sale)
+        order.currency_desired = currency_desired
+        order.amount_desired = long(amount_desired)
+        order.initial_amount_desired = long(initial_amount_desired)
+        order.price_key = get_price_key(
+            order.amount_desired, order.amount_for_sale)
+        cls.reserve_id(order_id)
+        return order
+
+    @classmethod
+    def from_records(cls, records):
+        """Create several orders at once.
+
+        Returns a list of Orders for (currency_for_sale, 
+        amount_for_sale, currency_desired, amount_desired, timestamp) 
+        tuples. The amounts must be positive integers and the 
+        currencies should be interned ids, see Currency.intern. Unlike 
+        the constructor, the records are not checked or rounded. If no 
+        timestamp is given, the time of the call is used for all 
+        orders."""
+        new = cls.__new__
+        now = None
+        order_id = cls.__id
+        orders = []
+
+        for (currency_for_sale, amount_for_sale, currency_desired,
+             amount_desired, timestamp) in records:
+            if timestamp is None:
+                if now is None:
+                    now = long(round(time.time() * 1000))
+                timestamp = now
+
+            order_id += 1
+            order = new(cls)
+            order.id = order_id
+            order.timestamp = timestamp
+            order.status = OrderStatus.New
+            order.expiry = None
+            order.currency_for_sale = currency_for_sale
+            order.currency_desired = currency_desired
+            order.amount_for_sale = order.initial_amount_for_sale = \
+                long(amount_for_sale)
+            order.amount_desired = order.initial_amount_desired = \
+                long(amount_desired)
+            order.price_key = get_price_key(
+                order.amount_desired, order.amount_for_sale)
+            orders.append(order)
+
+        cls.__id = order_id
+
+        # report creation of the new orders, if anyone is interested
+        if cls.onNewOrder:
+            for order in orders:
+                cls.report_new_order(order)
+
+        return orders
+
     @classmethod
     def create_sell_order(
             cls, amount_for_sale, price, currency_for_sale, currency_desired):
@@ -305,6 +860,8 @@ class Order(object):
     @classmethod
     def report_new_order(cls, order):
         """Fires an event for a new created Order."""
+        if not cls.onNewOrder:
+            return
         assert isinstance(order, Order)
         order.onNewOrder(order)
                 
@@ -312,6 +869,8 @@ class Order(object):
     def report_pending_update(
             cls, order, new_amount_for_sale, new_amount_desired):
         """Fires event with updated amounts before applying them."""
+        if not cls.onPendingAmountUpdate:
+            return
         assert isinstance(order, Order)
         assert isinstance(new_amount_for_sale, long)
         assert isinstance(new_amount_desired, long)
@@ -320,6 +879,8 @@ class Order(object):
     @classmethod
     def report_updated_order(cls, order, amount_received, amount_spent):
         """Fires event with given and received amounts after a trade."""
+        if not cls.onUpdatedOrder:
+            return
         assert isinstance(order, Order)
         assert isinstance(amount_received, long)
         assert isinstance(amount_spent, long)
@@ -328,19 +889,84 @@ class Order(object):
     @classmethod
     def report_status_update(cls, order, status):
         """Fires event with updated status."""
+        if not cls.onStatusUpdate:
+            return
         assert isinstance(order, Order)
         assert isinstance(status, int)
         cls.onStatusUpdate(order, status)
  
                
-class MatchingEngine:
-    __slots__ = ['orderbook']
+class Fill(collections.namedtuple("Fill", [
+        "sequence", "maker_id", "taker_id",
+        "amount_to_maker", "amount_to_taker"])):
+    """Compact record of a trade between a listed and a new order."""
+    __slots__ = ()
+
+    @property
+    def price(self):
+        """Exact unit price in the currency received by the maker per 
+        unit of the currency received by the taker."""
+        return Fraction(self.amount_to_maker, self.amount_to_taker)
+
+
+class FillBuffer(object):
+    """Bounded ring buffer of the fills of an engine.
+
+    Fills are consumed by iterating over the buffer, which removes 
+    them, or in lists of up to size fills with read. If the buffer is 
+    full, the oldest fill is overwritten and counted as lost, which is 
+    also visible as gap in the sequence numbers."""
+    __slots__ = ['fills', 'sequence', 'lost']
+
+    def __init__(self, capacity=4096):
+        self.fills = collections.deque(maxlen=capacity)
+        # sequence number of the next fill
+        self.sequence = 0
+        self.lost = 0
+
+    def __len__(self):
+        return len(self.fills)
+
+    def __iter__(self):
+        fills = self.fills
+        while fills:
+            yield fills.popleft()
+
+    def append(self, maker_id, taker_id, amount_to_maker, amount_to_taker):
+        if len(self.fills) == self.fills.maxlen:
+            self.lost += 1
+        self.fills.append(Fill(self.sequence, maker_id, taker_id,
+                               amount_to_maker, amount_to_taker))
+        self.sequence += 1
+
+    def read(self, size=None):
+        """Remove and return up to size of the oldest fills."""
+        fills = self.fills
+        if size is None or size >= len(fills):
+            batch = list(fills)
+            fills.clear()
+            return batch
+        return [fills.popleft() for _ in range(size)]
 
-    onOrderArrival = event.Event()
-    onTrade = event.Event()
 
-    def __init__(self):
-        self.orderbook = Orderbook()
+class MatchingEngine:
+    __slots__ = ['orderbook', 'validate', 'fills', 'strategy', 'archive']
+
+    onOrderArrival = event.Event("onOrderArrival")
+    onTrade = event.Event("onTrade")
+    onBatch = event.Event("onBatch")
+
+    def __init__(self, validate=True, strategy=DEFAULT_STRATEGY):
+        # in strict mode every step is sanity checked, otherwise only 
+        # the work required for matching is done
+        self.validate = validate
+        # priority, rounding of traded amounts and remaining amounts
+        self.strategy = strategy
+        self.orderbook = Orderbook(validate, strategy)
+        # FillBuffer of this engine or None
+        self.fills = None
+        # store of closed orders or None
+        self.archive = None
 
     def get_best_match(self, new_order):
         """Find best match for an order.
@@ -350,20 +976,21 @@ class MatchingEngine:
         one is chosen."""
         assert None != new_order
 
-        best_match = None
-
-        # get all open orders with matching currency pair
-        potential_orders = self.orderbook.get_orders(
+        # get the cheapest and oldest order with matching currency pair
+        best_match = self.orderbook.get_best_order(
             new_order.currency_desired, new_order.currency_for_sale)
 
-        # only orders with a favorable unit price are considered
-        potential_matches = \
-            list(filter(lambda order:
-                        order.matches_with(new_order), potential_orders))
-
-        # the best match should be the last item in the list
-        if len(potential_matches) > 0:
-            best_match = potential_matches[0]
+        # orders are sorted by price, so if the best order's unit price 
+        # isn't favorable, no other order's price is either
+        if best_match != None:
+            if self.validate:
+                matched = best_match.matches_with(new_order)
+            else:
+                # listed orders are open and the currency pair is given 
+                # by the orderbook, so only the price is relevant
+                matched = best_match.accepts_price_of(new_order)
+            if not matched:
+                best_match = None
 
         return best_match    
 
@@ -377,23 +1004,123 @@ class MatchingEngine:
         are updated. This is done repeatingly until no more matches 
         are found. If the order is still (partially) unfulfilled, the 
         order is added to the orderbook."""
-        assert None != order_new
-
         # announce arrival of a new order
-        self.report_order_arrival(order_new)
+        if self.validate:
+            assert None != order_new
+            self.report_order_arrival(order_new)
+        else:
+            self.onOrderArrival(order_new)
 
-        # the best match is the cheapest and oldest one
-        best_match = self.get_best_match(order_new)
+        # orders, which arrive after their expiry, are not executed
+        if self.orderbook.is_expired(order_new):
+            self.expire_order(order_new)
+            return order_new
+
+        # the opposite side of the orderbook is walked from the best 
+        # price on, until the order is filled or the price is no longer 
+        # acceptable
+        while order_new.status != OrderStatus.Filled:
+            # the best match is the cheapest and oldest one
+            best_match = self.get_best_match(order_new)
+
+            if best_match == None:
+                # add order to the orderbook
+                self.list_order(order_new)
+                break
 
-        if best_match != None:
             # the order is executed
-            self.execute_orders(best_match, order_new)                                    
-        else:
-            # add order to the orderbook
-            self.orderbook.list(order_new)
-        
+            self.execute_orders(best_match, order_new)
+
+        if order_new.status == OrderStatus.Filled:
+            self.retire(order_new)
+
         return order_new
 
+    def stream_fills(self, capacity=4096):
+        """Record the fills of this engine in a FillBuffer.
+
+        Returns the FillBuffer, which is kept until stream_fills is 
+        called again."""
+        self.fills = FillBuffer(capacity)
+        return self.fills
+
+    def archive_orders(self, archive):
+        """Hand filled, canceled and expired orders over to an archive.
+
+        The archive is an object with an add(order) method, e.g. an 
+        archive.OrderArchive, which is returned."""
+        self.archive = archive
+        return archive
+
+    def retire(self, order):
+        """Archive a closed order, if the engine has an archive."""
+        if self.archive is not None:
+            self.archive.add(order)
+
+    def get_order(self, order_id):
+        """Get an open order or the archived state of a closed order.
+
+        Returns None, if the order is neither open nor archived."""
+        order = self.orderbook.get_order(order_id)
+        if order is None and self.archive is not None:
+            order = self.archive.get(order_id)
+        return order
+
+    def list_order(self, order):
+        """Add a remaining order to the orderbook.
+
+        Orders, which expired already, are not listed, but only marked 
+        as expired."""
+        if self.orderbook.is_expired(order):
+            self.expire_order(order)
+        else:
+            self.orderbook.list(order)
+
+    def expire_order(self, order):
+        """Mark an order, which expired before it was listed, as 
+        expired."""
+        order.set_status(OrderStatus.Expired, self.validate)
+        self.retire(order)
+
+    def advance_to(self, height):
+        """Expire all open orders with an expiry up to the block height.
+
+        Returns the list of expired Orders."""
+        expired = self.orderbook.expire(height)
+        for order in expired:
+            self.retire(order)
+        return expired
+
+    def cancel_order(self, order_id):
+        """Cancel an open order.
+
+        Returns the canceled Order or None, if there is no open order 
+        with the given id."""
+        order = self.orderbook.cancel(order_id)
+        if order is not None:
+            self.retire(order)
+        return order
+
+    def add_orders(self, orders, forward=False):
+        """Add several orders.
+
+        Returns the list of Orders after execution or listing.
+
+        The orders are added one after another. Instead of firing each 
+        event separately, the events of the whole batch are collected 
+        and delivered with a single onBatch event as list of (event 
+        name, arguments) tuples, e.g. ("onTrade", (order_a1, order_a2, 
+        amount_to_a1, amount_to_a2)). The orders in the list reflect 
+        the state after the batch. If forward is set, the handlers of 
+        the single events are called as well."""
+        batch = event.EventBatch(self.get_batched_events(), forward)
+
+        with batch:
+            orders_added = [self.add_order(order) for order in orders]
+
+        self.report_batch(batch.records)
+        return orders_added
+
     def get_traded_amounts(self, order_old, order_new):
         """Calculate traded amounts.
 
@@ -406,28 +1133,21 @@ class MatchingEngine:
         assert order_old.matches_with(order_new)
         assert order_new.matches_with(order_old)
 
-        # extra variables are used for better readability
-        a1_available = order_old.amount_for_sale
-        a1_unit_price = order_old.get_unit_price()
-        
-        # only whole units can be traded!
-        a1_desired = math.ceil(order_old.amount_desired)
-        a2_desired = math.ceil(order_new.amount_desired)
-        assert a1_desired == order_old.amount_desired
-        assert a2_desired == order_new.amount_desired
-        
-        # these are the traded amounts
-        amount_to_a2 = long(min(a2_desired, a1_available))
-        amount_to_a1 = long(math.ceil(amount_to_a2 * a1_unit_price))
+        (amount_to_a1, amount_to_a2) = \
+            self.calculate_traded_amounts(order_old, order_new)
         
         # check, if price after rounding up is within accepted range
-        updated_unit_price = float(amount_to_a1) /  float(amount_to_a2)
-        updated_unit_price_inverse = float(amount_to_a2) /  float(amount_to_a1)
-        assert order_old.would_accept(updated_unit_price)
-        assert order_new.would_accept(updated_unit_price_inverse)
+        assert order_old.would_accept(Fraction(amount_to_a1, amount_to_a2))
+        assert order_new.would_accept(Fraction(amount_to_a2, amount_to_a1))
 
         return (amount_to_a1, amount_to_a2)
 
+    def calculate_traded_amounts(self, order_old, order_new):
+        """Calculate traded amounts without any checks.
+
+        The orders are assumed to match with each other."""
+        return self.strategy.calculate_traded_amounts(order_old, order_new)
+
     def execute_orders(self, order_old, order_new):
         """Match and execute two orders.
       
@@ -436,50 +1156,81 @@ class MatchingEngine:
         be considered as threshold or upper limit.
 
         In the case an existing order is filled partially, the order 
-        is updated.
+        is updated. Filled existing orders are removed from the 
+        orderbook."""
+        validate = self.validate
+
+        # determine the actually traded amounts and report the trade
+        if validate:
+            (amount_to_a1, amount_to_a2) = \
+                self.get_traded_amounts(order_old, order_new)
+            self.report_trade(
+                order_old, order_new, amount_to_a1, amount_to_a2)
+        else:
+            (amount_to_a1, amount_to_a2) = \
+                self.calculate_traded_amounts(order_old, order_new)
+            self.onTrade(order_old, order_new, amount_to_a1, amount_to_a2)
 
-        A new order is matched against existing orders until the order 
-        is completely filled or no potential match is found."""
-        # determine the actually traded amounts
-        (amount_to_a1, amount_to_a2) = \
-            self.get_traded_amounts(order_old, order_new)
-        
-        # report trade
-        self.report_trade(order_old, order_new, amount_to_a1, amount_to_a2)
+        if self.fills is not None:
+            self.fills.append(
+                order_old.id, order_new.id, amount_to_a1, amount_to_a2)
         
         # update existing order based on traded amounts
-        order_old.update_order(amount_to_a1, amount_to_a2)
+        order_old.update_order(
+            amount_to_a1, amount_to_a2, validate, self.strategy)
                 
         if order_old.status == OrderStatus.Filled:
             # the existing order is removed from the orderbook
             self.orderbook.delist(order_old)
+            self.retire(order_old)
+        else:
+            # the price may have changed due to rounding
+            self.orderbook.refresh(order_old)
 
         # update pending order based on traded amounts
-        order_new.update_order(amount_to_a2, amount_to_a1)
-        
-        if order_new.status != OrderStatus.Filled:
-            # the updated, new order is enqueued until filled or listed
-            self.add_order(order_new)
+        order_new.update_order(
+            amount_to_a2, amount_to_a1, validate, self.strategy)
     
     def __str__(self):
         response = "Open Orders:"
         if not self.orderbook:
             response += "\nNo open orders available."
-        for order in self.orderbook.orders:
+        for order in self.orderbook.orders.values():
             response += "\n" + str(order)
         return response
     
+    @classmethod
+    def get_batched_events(cls):
+        """Events, which are collected while adding a batch of orders."""
+        return [
+            cls.onOrderArrival, cls.onTrade,
+            Orderbook.onListing, Orderbook.onDelisting,
+            Order.onNewOrder, Order.onPendingAmountUpdate,
+            Order.onUpdatedOrder, Order.onStatusUpdate]
+
     @classmethod
     def report_order_arrival(cls, order):
         """Fires event for enqueued Order."""
+        if not cls.onOrderArrival:
+            return
         assert isinstance(order, Order)
         cls.onOrderArrival(order)
 
     @classmethod
     def report_trade(cls, order_a1, order_a2, amount_to_a1, amount_to_a2):
         """Fires event after a trade with traded amounts and orders."""
+        if not cls.onTrade:
+            return
         assert isinstance(order_a1, Order)
         assert isinstance(order_a2, Order)
         assert isinstance(amount_to_a1, long)
         assert isinstance(amount_to_a2, long)
-        cls.onTrade(order_a1, order_a2, amount_to_a1, amount_to_a2)
\ No newline at end of file
+        cls.onTrade(order_a1, order_a2, amount_to_a1, amount_to_a2)
+
+    @classmethod
+    def report_batch(cls, records):
+        """Fires event with all events collected during a batch."""
+        if not cls.onBatch:
+            return
+        assert isinstance(records, list)
+        cls.onBatch(records)
\ No newline at end of file
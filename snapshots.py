@@ -0,0 +1,378 @@
+import collections
+
+
+# the publisher mirrors the open orders of an Orderbook as immutable
+# records and publishes versioned, read-only snapshots of the book. the
+# matching thread decides when a snapshot is published, e.g. after each
+# order, so the snapshots never contain half-executed trades.
+#
+# a snapshot consists of one snapshot per currency pair and an index of
+# all orders by id. both, the orders of a pair and the index, are kept
+# in persistent maps, which are tries of nodes with 32 slots. a changed
+# order only copies the nodes on its path, all other nodes are shared
+# with the previous version, so publishing costs O(log n) per changed
+# order instead of O(n) per changed pair. a new snapshot becomes visible
+# by replacing a single reference, so readers in other threads neither
+# lock nor block the matching thread and keep a consistent view for as
+# long as they hold on to a snapshot.
+#
+# orders of a pair are only sorted, when a reader asks for it.
+
+# bits of the hash, which select the slot in a node of a PersistentMap
+NODE_BITS = 5
+NODE_SIZE = 1 << NODE_BITS
+NODE_MASK = NODE_SIZE - 1
+HASH_MASK = (1 << 64) - 1
+# deeper nodes would only hold keys with the same hash, which are kept 
+# in a list instead
+MAX_SHIFT = 64
+
+EMPTY_NODE = (None, ) * NODE_SIZE
+
+
+class PersistentMap(object):
+    """Immutable map, whose updated copies share most of their nodes.
+
+    Nodes are tuples of NODE_SIZE slots, which are selected by the bits 
+    of the hash of the key. A slot is either None, a (hash, key, value) 
+    entry, another node or, for keys with the same hash, a list of 
+    entries. An entry is stored at the first level, at which its slot 
+    is not shared with other keys. set and remove return a new map and copy only the nodes on
+    the path to the key."""
+    __slots__ = ['root', 'size']
+
+    def __init__(self, root=EMPTY_NODE, size=0):
+        self.root = root
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for (key, _) in self.iteritems():
+            yield key
+
+    def get(self, key, default=None):
+        key_hash = hash(key) & HASH_MASK
+        node = self.root
+        shift = 0
+        while True:
+            slot = node[(key_hash >> shift) & NODE_MASK]
+            if slot is None:
+                return default
+            if type(slot) is list:
+                for entry in slot:
+                    if entry[1] == key:
+                        return entry[2]
+                return default
+            if len(slot) == 3:
+                if slot[1] == key:
+                    return slot[2]
+                return default
+            node = slot
+            shift += NODE_BITS
+
+    def set(self, key, value):
+        key_hash = hash(key) & HASH_MASK
+        (root, added) = self.set_entry(
+            self.root, 0, (key_hash, key, value))
+        return PersistentMap(root, self.size + added)
+
+    def remove(self, key):
+        """Get a copy without the key, which may be missing."""
+        key_hash = hash(key) & HASH_MASK
+        root = self.remove_entry(self.root, 0, key_hash, key)
+        if root is self.root:
+            return self
+        if root is None:
+            root = EMPTY_NODE
+        return PersistentMap(root, self.size - 1)
+
+    @classmethod
+    def set_entry(cls, node, shift, entry):
+        """Get a copy of a node with the entry and the number of added 
+        keys."""
+        index = (entry[0] >> shift) & NODE_MASK
+        slot = node[index]
+        added = 0
+        if slot is None:
+            slot = entry
+            added = 1
+        elif type(slot) is list:
+            slot = [other for other in slot if other[1] != entry[1]]
+            added = len(slot) - len(node[index]) + 1
+            slot.append(entry)
+        elif len(slot) == 3:
+            if slot[1] == entry[1]:
+                slot = entry
+            elif shift + NODE_BITS >= MAX_SHIFT:
+                slot = [slot, entry]
+                added = 1
+            else:
+                # the existing entry is moved one level down
+                child = cls.set_entry(EMPTY_NODE, shift + NODE_BITS, slot)[0]
+                (slot, added) = cls.set_entry(child, shift + NODE_BITS, entry)
+        else:
+            (slot, added) = cls.set_entry(slot, shift + NODE_BITS, entry)
+        return (node[:index] + (slot, ) + node[index + 1:], added)
+
+    @classmethod
+    def remove_entry(cls, node, shift, key_hash, key):
+        """Get a copy of a node without the key, the node itself, if 
+        the key is missing, or None, if the copy would be empty."""
+        index = (key_hash >> shift) & NODE_MASK
+        slot = node[index]
+        if slot is None:
+            return node
+        if type(slot) is list:
+            entries = [entry for entry in slot if entry[1] != key]
+            if len(entries) == len(slot):
+                return node
+            slot = entries
+            if len(entries) == 1:
+                slot = entries[0]
+        elif len(slot) == 3:
+            if slot[1] != key:
+                return node
+            slot = None
+        else:
+            child = cls.remove_entry(slot, shift + NODE_BITS, key_hash, key)
+            if child is slot:
+                return node
+            slot = child
+            if child is not None:
+                # a node with a single entry is replaced by the entry
+                slots = [other for other in child if other is not None]
+                if len(slots) == 1 and len(slots[0]) == 3 \
+                        and type(slots[0]) is tuple:
+                    slot = slots[0]
+
+        copy = node[:index] + (slot, ) + node[index + 1:]
+        if copy == EMPTY_NODE:
+            return None
+        return copy
+
+    def iteritems(self):
+        nodes = [self.root]
+        while nodes:
+            for slot in nodes.pop():
+                if slot is None:
+                    continue
+                if type(slot) is list:
+                    for entry in slot:
+                        yield (entry[1], entry[2])
+                elif len(slot) == 3:
+                    yield (slot[1], slot[2])
+                else:
+                    nodes.append(slot)
+
+    def itervalues(self):
+        for (_, value) in self.iteritems():
+            yield value
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class OrderView(collections.namedtuple("OrderView", [
+        "id", "timestamp", "status", "currency_for_sale", "amount_for_sale",
+        "currency_desired", "amount_desired", "price_key", "sequence"])):
+    """Immutable state of an open order at the time of a snapshot."""
+    __slots__ = ()
+
+    def get_unit_price(self):
+        return float(self.amount_desired) / float(self.amount_for_sale)
+
+    def __str__(self):
+        return "[ID %i] offers %i %s, desires %i %s at %f (%f)" % \
+            (self.id, self.amount_for_sale, self.currency_for_sale,
+             self.amount_desired, self.currency_desired,
+             self.get_unit_price(), 1.0 / self.get_unit_price())
+
+
+class PairSnapshot(object):
+    """Open orders of one (currency_for_sale, currency_desired) pair."""
+    __slots__ = ['pair', 'version', 'orders', 'sorted_orders']
+
+    def __init__(self, pair, version, orders):
+        self.pair = pair
+        # version of the snapshot, in which the pair last changed
+        self.version = version
+        # PersistentMap of order id -> OrderView
+        self.orders = orders
+        self.sorted_orders = None
+
+    def __len__(self):
+        return len(self.orders)
+
+    def get_orders(self):
+        """Get the orders sorted by price, whereby old orders are
+        prioritized."""
+        # concurrent readers may sort at the same time, but they get
+        # the same result
+        if self.sorted_orders is None:
+            self.sorted_orders = tuple(sorted(
+                self.orders.itervalues(),
+                key=lambda view: (view.price_key, view.timestamp,
+                                  view.sequence)))
+        return self.sorted_orders
+
+    def get_best_order(self):
+        orders = self.get_orders()
+        if orders:
+            return orders[0]
+        return None
+
+
+class BookSnapshot(object):
+    """Consistent, read-only view of the open orders of an Orderbook."""
+    __slots__ = ['version', 'pairs', 'orders']
+
+    def __init__(self, version, pairs=PersistentMap(), orders=PersistentMap()):
+        self.version = version
+        # PersistentMap of (currency_for_sale, currency_desired) -> 
+        # PairSnapshot
+        self.pairs = pairs
+        # PersistentMap of order id -> OrderView of all pairs
+        self.orders = orders
+
+    def __len__(self):
+        return len(self.orders)
+
+    def get_pairs(self):
+        return list(self.pairs)
+
+    def get_orders(self, currency_for_sale, currency_desired):
+        """Get orders with the desired currency pair.
+
+        Orders are sorted by price whereby old orders are prioritized."""
+        pair = self.pairs.get((currency_for_sale, currency_desired))
+        if pair is None:
+            return ()
+        return pair.get_orders()
+
+    def get_best_order(self, currency_for_sale, currency_desired):
+        pair = self.pairs.get((currency_for_sale, currency_desired))
+        if pair is None:
+            return None
+        return pair.get_best_order()
+
+    def get_order(self, order_id):
+        """Get an open order by id or None."""
+        return self.orders.get(order_id)
+
+    def __str__(self):
+        response = "Open Orders:"
+        views = sorted(self.orders.itervalues(),
+                       key=lambda view: view.sequence)
+        if not views:
+            response += "\nNo open orders available."
+        for view in views:
+            response += "\n" + str(view)
+        return response
+
+
+class SnapshotPublisher(object):
+    """Publishes snapshots of an Orderbook for concurrent readers.
+
+    The publisher is attached to the orderbook as mirror. The matching
+    thread calls publish, readers use the current snapshot:
+
+        publisher = SnapshotPublisher(engine.orderbook)
+        engine.add_order(order)
+        publisher.publish()
+
+        # in another thread
+        snapshot = publisher.current
+    """
+
+    def __init__(self, orderbook):
+        # pair -> order id -> OrderView or None for removed orders of 
+        # the changes since the last publication
+        self.changes = {}
+        # listing sequence of the open orders, to break ties like the
+        # orderbook
+        self.sequences = {}
+        self.sequence = 0
+        self.current = BookSnapshot(0)
+
+        self.orderbook = orderbook
+        orderbook.attach(self)
+        self.publish()
+
+    def close(self):
+        """Stop mirroring the orderbook."""
+        self.orderbook.detach(self)
+
+    def get_view(self, order):
+        return OrderView(
+            order.id, order.timestamp, order.status,
+            order.currency_for_sale, order.amount_for_sale,
+            order.currency_desired, order.amount_desired,
+            order.price_key, self.sequences[order.id])
+
+    def add(self, order):
+        pair = (order.currency_for_sale, order.currency_desired)
+        self.sequences[order.id] = self.sequence
+        self.sequence += 1
+        self.changes.setdefault(pair, {})[order.id] = self.get_view(order)
+
+    def update(self, order):
+        pair = (order.currency_for_sale, order.currency_desired)
+        self.changes.setdefault(pair, {})[order.id] = self.get_view(order)
+
+    def remove(self, order):
+        pair = (order.currency_for_sale, order.currency_desired)
+        self.changes.setdefault(pair, {})[order.id] = None
+        del self.sequences[order.id]
+
+    def publish(self):
+        """Publish the current state of the orderbook.
+
+        Only the changed orders are applied to the previous snapshot, 
+        whose unchanged parts are shared. Returns the published 
+        BookSnapshot."""
+        if not self.changes and self.current.version:
+            return self.current
+
+        version = self.current.version + 1
+        pairs = self.current.pairs
+        orders = self.current.orders
+        for (pair, changes) in self.changes.iteritems():
+            snapshot = pairs.get(pair)
+            pair_orders = PersistentMap()
+            if snapshot is not None:
+                pair_orders = snapshot.orders
+            for (order_id, view) in changes.iteritems():
+                if view is None:
+                    pair_orders = pair_orders.remove(order_id)
+                    orders = orders.remove(order_id)
+                else:
+                    pair_orders = pair_orders.set(order_id, view)
+                    orders = orders.set(order_id, view)
+            if pair_orders:
+                pairs = pairs.set(
+                    pair, PairSnapshot(pair, version, pair_orders))
+            else:
+                pairs = pairs.remove(pair)
+        self.changes.clear()
+
+        # replacing the reference is atomic, so readers get either the
+        # previous or the new snapshot
+        self.current = BookSnapshot(version, pairs, orders)
+        return self.current
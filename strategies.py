@@ -0,0 +1,216 @@
+import argparse
+import multiprocessing
+import random
+import timeit
+from fractions import Fraction
+
+import journal
+from simple_order_matching import \
+    Order, MatchingEngine, MatchingStrategy, DEFAULT_STRATEGY
+
+# alternative matching strategies and a runner, which replays the same
+# order flow with several strategies in parallel worker processes.
+#
+# the flow is a list of actions as generated by the benchmark scenarios:
+# ("order", arguments of Order), ("cancel", index), whereby index refers
+# to the n-th order of the flow, or ("advance", block height).
+#
+# for each strategy the fills, the traded volume and the rounding
+# leakage are collected. the leakage is the amount listed orders receive
+# above their exact limit price, summed up per currency.
+
+
+class SizePriorityStrategy(MatchingStrategy):
+    """Larger orders are executed first among orders with the same
+    price."""
+
+    name = "price-size"
+
+    def get_priority(self, order):
+        return (-order.amount_for_sale, order.timestamp)
+
+
+class TakerPriceStrategy(MatchingStrategy):
+    """Trades are executed at the limit price of the new order, so the
+    listed orders receive the price improvement."""
+
+    name = "taker-price"
+
+    def calculate_traded_amounts(self, order_old, order_new):
+        (amount_to_a1, amount_to_a2) = MatchingStrategy \
+            .calculate_traded_amounts(self, order_old, order_new)
+
+        # the most the new order accepts to pay, whereby the listed
+        # order doesn't receive more than desired
+        amount_at_limit = amount_to_a2 * order_new.amount_for_sale \
+            // order_new.amount_desired
+        amount_to_a1 = max(
+            amount_to_a1, min(amount_at_limit, order_old.amount_desired))
+
+        return (amount_to_a1, amount_to_a2)
+
+
+class FloorRemainderStrategy(MatchingStrategy):
+    """The remaining amount for sale of partially filled orders is
+    rounded down, so the unit price of the remaining order rises."""
+
+    name = "floor-remainder"
+
+    def calculate_remaining_amount_for_sale(self, order, amount_desired):
+        amount_for_sale = amount_desired * order.amount_for_sale \
+            // order.amount_desired
+        # an open order offers at least one unit
+        if amount_for_sale == 0 and amount_desired > 0:
+            return 1
+        return amount_for_sale
+
+
+STRATEGIES = [
+    DEFAULT_STRATEGY,
+    SizePriorityStrategy(),
+    TakerPriceStrategy(),
+    FloorRemainderStrategy(),
+]
+
+
+def read_flow(path):
+    """Convert the entries of a journal into a flow."""
+    (entries, _) = journal.read_journal(path)
+    flow = []
+    # order id -> index in the flow
+    indexes = {}
+    for (entry_type, entry) in entries:
+        if entry_type == "order":
+            indexes[entry.id] = len(indexes)
+            flow.append(("order", (
+                entry.currency_for_sale, entry.amount_for_sale,
+                entry.currency_desired, entry.amount_desired,
+                entry.timestamp, 0, entry.expiry)))
+        elif entry_type == "cancel":
+            if entry in indexes:
+                flow.append(("cancel", indexes[entry]))
+        else:
+            flow.append(("advance", entry))
+    return flow
+
+
+def run_strategy(arguments):
+    """Replay a flow with one strategy.
+
+    Returns a dict with the name of the strategy, the fills as (index
+    of the listed order, index of the new order, amount to the listed
+    order, amount to the new order) tuples, the traded volume and
+    leakage per currency, the number of open orders and the actions per
+    second."""
+    (flow, strategy, validate) = arguments
+
+    orders = [Order(*payload) for (action, payload) in flow
+              if action == "order"]
+    # order id -> index in the flow
+    indexes = dict((order.id, index) for (index, order) in enumerate(orders))
+
+    fills = []
+    volume = {}
+    leakage = {}
+
+    def trade_callback(order_a1, order_a2, amount_to_a1, amount_to_a2):
+        fills.append((indexes[order_a1.id], indexes[order_a2.id],
+                      amount_to_a1, amount_to_a2))
+        for (currency, amount) in ((order_a1.currency_desired, amount_to_a1),
+                                   (order_a2.currency_desired, amount_to_a2)):
+            volume[currency] = volume.get(currency, 0) + amount
+
+        # the amount above the exact limit price of the listed order.
+        # the sum is a float, as the denominators of exact sums grow
+        # with each trade
+        excess = Fraction(
+            amount_to_a1 * order_a1.amount_for_sale
+            - amount_to_a2 * order_a1.amount_desired,
+            order_a1.amount_for_sale)
+        currency = order_a1.currency_desired
+        leakage[currency] = leakage.get(currency, 0.0) + float(excess)
+
+    MatchingEngine.onTrade += trade_callback
+    try:
+        engine = MatchingEngine(validate, strategy)
+        order_iterator = iter(orders)
+
+        start = timeit.default_timer()
+        for (action, payload) in flow:
+            if action == "order":
+                engine.add_order(next(order_iterator))
+            elif action == "cancel":
+                engine.cancel_order(orders[payload].id)
+            else:
+                engine.advance_to(payload)
+        elapsed = timeit.default_timer() - start
+    finally:
+        MatchingEngine.onTrade -= trade_callback
+
+    return {
+        "strategy": strategy.name,
+        "fills": fills,
+        "volume": volume,
+        "leakage": leakage,
+        "open_orders": len(engine.orderbook.orders),
+        "actions_per_second": len(flow) / elapsed if elapsed else 0.0,
+    }
+
+
+def compare(flow, strategies=STRATEGIES, processes=None, validate=False):
+    """Replay a flow with several strategies in parallel.
+
+    Returns the results of run_strategy in the order of the strategies,
+    whereby "common_fills" is the number of fills, which are identical
+    to the fills of the first strategy."""
+    if processes is None:
+        processes = min(len(strategies), multiprocessing.cpu_count())
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(
+            run_strategy,
+            [(flow, strategy, validate) for strategy in strategies])
+    finally:
+        pool.close()
+        pool.join()
+
+    baseline = set(results[0]["fills"])
+    for result in results:
+        result["common_fills"] = len(baseline.intersection(result["fills"]))
+    return results
+
+
+if __name__ == "__main__":
+    import benchmark
+
+    parser = argparse.ArgumentParser(
+        description="Compare matching strategies with the same order flow.")
+    parser.add_argument("scenario", nargs="?", default="satoshi",
+                        help="benchmark scenario, one of: %s" %
+                        ", ".join(name for (name, _) in benchmark.SCENARIOS))
+    parser.add_argument("--journal", help="replay the orders of a journal")
+    parser.add_argument("--orders", type=int, default=50000,
+                        help="number of actions of the scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--validate", action="store_true",
+                        help="run the engines with sanity checks")
+    args = parser.parse_args()
+
+    if args.journal:
+        flow = read_flow(args.journal)
+    else:
+        generate = dict(benchmark.SCENARIOS)[args.scenario]
+        flow = generate(random.Random(args.seed), args.orders)
+
+    results = compare(flow, STRATEGIES, args.processes, args.validate)
+
+    print("%-16s %10s %10s %12s %10s  %s" % (
+        "strategy", "fills", "common", "actions/s", "open", "leakage"))
+    for result in results:
+        print("%-16s %10i %10i %12.0f %10i  %s" % (
+            result["strategy"], len(result["fills"]), result["common_fills"],
+            result["actions_per_second"], result["open_orders"],
+            ", ".join("%s %.1f" % item
+                      for item in sorted(result["leakage"].items()))))